@@ -0,0 +1,263 @@
+"""Benchmarks the stages of dedup_files() on a synthetic image tree.
+
+The tree is generated from a fixed seed, so runs with the same settings see the
+same files and can be compared. It mixes JPEGs and PNGs of several sizes, exact
+copies and near duplicates (re-encoded, resized or slightly brightened).
+
+Each stage is timed separately:
+  - hash_cold: compute_hashes() with an empty hash store.
+  - hash_warm: compute_hashes() again with the hashes of the cold run cached.
+  - html: utils.write_html() of every hash type.
+  - move: maybe_move() of the md5 groups.
+and reported as files/s and MB/s of the tree, along with the peak RSS of the
+stage. Each stage runs in a fresh process, since the peak RSS of a process
+can't be reset, and its result is sent back to be passed to the next stages.
+The results are saved as json.
+"""
+import concurrent.futures
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image
+
+import create_dup_images_html
+import hash_store as hash_store_lib
+import utils
+
+# (width, height) of the generated images.
+_IMAGE_SIZES = ((320, 240), (800, 600), (1600, 1200), (600, 900))
+
+
+def _random_image(rng: np.random.Generator, width: int, height: int):
+  """Returns a smooth random RGB image, so near duplicates have close hashes."""
+  coarse = rng.integers(0, 256, size=(6, 8, 3), dtype=np.uint8)
+  img = Image.fromarray(coarse).resize((width, height), Image.BICUBIC)
+  noise = rng.integers(-8, 9, size=(height, width, 3))
+  pixels = np.clip(np.asarray(img, dtype=np.int16) + noise, 0, 255)
+  return Image.fromarray(pixels.astype(np.uint8))
+
+
+def _save(img: Image.Image, path: str, fmt: str, quality: int = 90):
+  os.makedirs(os.path.dirname(path), exist_ok=True)
+  if fmt == 'JPEG':
+    img.save(path, fmt, quality=quality)
+  else:
+    img.save(path, fmt)
+
+
+def generate_corpus(
+    root_dir: str,
+    num_images: int = 500,
+    exact_dup_ratio: float = 0.1,
+    near_dup_ratio: float = 0.1,
+    seed: int = 0,
+) -> dict[str, int]:
+  """Generates the synthetic tree under root_dir, returns its stats."""
+  rng = np.random.default_rng(seed)
+  num_exact_dups = int(num_images * exact_dup_ratio)
+  num_near_dups = int(num_images * near_dup_ratio)
+  num_originals = num_images - num_exact_dups - num_near_dups
+
+  originals = []
+  for i in range(num_originals):
+    width, height = _IMAGE_SIZES[rng.integers(len(_IMAGE_SIZES))]
+    fmt = 'JPEG' if rng.random() < 0.7 else 'PNG'
+    ext = 'jpg' if fmt == 'JPEG' else 'png'
+    path = os.path.join(root_dir, f'd{i % 10}', f'e{i % 7}', f'img{i}.{ext}')
+    img = _random_image(rng, width, height)
+    _save(img, path, fmt)
+    originals.append((path, img, fmt))
+
+  for i in range(num_exact_dups):
+    src_path, _, _ = originals[rng.integers(len(originals))]
+    ext = os.path.splitext(src_path)[1]
+    dst_path = os.path.join(root_dir, 'copies', f'd{i % 5}', f'copy{i}{ext}')
+    os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+    shutil.copyfile(src_path, dst_path)
+
+  for i in range(num_near_dups):
+    _, img, fmt = originals[rng.integers(len(originals))]
+    kind = i % 3
+    if kind == 0:
+      near_img = img
+      quality = 70
+    elif kind == 1:
+      near_img = img.resize((img.width * 3 // 4, img.height * 3 // 4))
+      quality = 90
+    else:
+      near_img = Image.eval(img, lambda v: min(v + 6, 255))
+      quality = 90
+    ext = 'jpg' if fmt == 'JPEG' else 'png'
+    path = os.path.join(root_dir, 'near', f'd{i % 5}', f'near{i}.{ext}')
+    _save(near_img, path, fmt, quality=quality)
+
+  num_files = 0
+  num_bytes = 0
+  for entry in create_dup_images_html._iter_files(
+      root_dir, use_manifest=False
+  ):
+    num_files += 1
+    num_bytes += entry.size
+  return {
+      'num_files': num_files,
+      'num_bytes': num_bytes,
+      'num_exact_dups': num_exact_dups,
+      'num_near_dups': num_near_dups,
+  }
+
+
+def _peak_rss_mb(who: int) -> float:
+  # ru_maxrss is in KB on Linux and in bytes on macOS.
+  max_rss = resource.getrusage(who).ru_maxrss
+  if sys.platform == 'darwin':
+    return max_rss / 2**20
+  return max_rss / 2**10
+
+
+def _run_stage(fn, args, kwargs):
+  """Runs the stage in the current, fresh, process. Returns its measurements.
+
+  The peak RSS also counts the baseline of the process: the interpreter, the
+  imported modules and the arguments.
+  """
+  start = time.perf_counter()
+  result = fn(*args, **kwargs)
+  secs = time.perf_counter() - start
+  return result, secs, _peak_rss_mb(resource.RUSAGE_SELF), _peak_rss_mb(
+      resource.RUSAGE_CHILDREN
+  )
+
+
+class _StageTimer:
+
+  def __init__(self, num_files: int, num_bytes: int):
+    self.num_files = num_files
+    self.num_bytes = num_bytes
+    self.stages = {}
+
+  def time(self, name: str, fn, *args, **kwargs):
+    """Runs fn in its own process, and returns its result.
+
+    fn, its arguments and its result must be picklable.
+    """
+    with concurrent.futures.ProcessPoolExecutor(1) as executor:
+      result, secs, peak_rss_mb, peak_children_rss_mb = executor.submit(
+          _run_stage, fn, args, kwargs
+      ).result()
+    self.stages[name] = {
+        'secs': secs,
+        'files_per_sec': self.num_files / secs,
+        'mb_per_sec': self.num_bytes / 2**20 / secs,
+        # Of the process running the stage, and of its largest worker.
+        'stage_peak_rss_mb': peak_rss_mb,
+        'stage_peak_worker_rss_mb': peak_children_rss_mb,
+    }
+    print(
+        f'{name:<12}{secs:>10.2f}{self.num_files / secs:>10.1f}'
+        f'{self.num_bytes / 2**20 / secs:>10.1f}'
+        f'{peak_rss_mb:>12.1f}{peak_children_rss_mb:>12.1f}'
+    )
+    return result
+
+
+def _hash(src_root_dir, hash_type_to_deduper, store_path, jobs):
+  with hash_store_lib.HashStore(store_path) as hash_store:
+    image_files, hash_to_rows = create_dup_images_html.compute_hashes(
+        src_root_dir, hash_type_to_deduper, hash_store, jobs=jobs
+    )
+  # Plain dicts, to be sent back to the benchmark process.
+  return image_files, {
+      hash_type: dict(groups) for hash_type, groups in hash_to_rows.items()
+  }
+
+
+def _write_htmls(src_root_dir, image_files, hash_to_rows, thumbnail_dir):
+  for hash_type, groups in hash_to_rows.items():
+    utils.write_html(
+        os.path.join(src_root_dir, f'image_mapping_{hash_type}.html'),
+        groups,
+        scale_image_by_width=True,
+        thumbnail_dir=thumbnail_dir,
+        file_table=image_files,
+    )
+
+
+def benchmark(
+    result_path: str,
+    num_images: int = 500,
+    jobs: int = 1,
+    seed: int = 0,
+    hash_types=None,
+    thumbnail_dir: str | None = None,
+    work_dir: str | None = None,
+):
+  """Runs the benchmark in a temp dir, and saves the results to result_path.
+
+  The thumbnails are made in a temp dir when thumbnail_dir is None. Pass
+  thumbnail_dir='' to link the original images in the htmls instead.
+  """
+  with tempfile.TemporaryDirectory(dir=work_dir) as tmp_dir:
+    src_root_dir = os.path.join(tmp_dir, 'src')
+    start = time.perf_counter()
+    corpus_stats = generate_corpus(src_root_dir, num_images, seed=seed)
+    print(
+        f'\033[93m=> Generated {corpus_stats["num_files"]} files, '
+        f'{corpus_stats["num_bytes"] / 2**20:.1f}MB in '
+        f'{time.perf_counter() - start:.1f}s.\033[0m'
+    )
+    if thumbnail_dir is None:
+      thumbnail_dir = os.path.join(tmp_dir, 'thumbnails')
+    store_path = os.path.join(tmp_dir, 'hash_all.sqlite')
+    dst_root_dir = os.path.join(tmp_dir, 'dst')
+
+    _, hash_type_to_deduper = create_dup_images_html.make_dedupers(hash_types)
+    timer = _StageTimer(corpus_stats['num_files'], corpus_stats['num_bytes'])
+    print(f'{"stage":<12}{"secs":>10}{"files/s":>10}{"MB/s":>10}'
+          f'{"peak_rss_mb":>12}{"worker_mb":>12}')
+    timer.time(
+        'hash_cold', _hash, src_root_dir, hash_type_to_deduper, store_path, jobs
+    )
+    image_files, hash_to_rows = timer.time(
+        'hash_warm', _hash, src_root_dir, hash_type_to_deduper, store_path, jobs
+    )
+    timer.time(
+        'html', _write_htmls, src_root_dir, image_files, hash_to_rows,
+        thumbnail_dir or None
+    )
+    if 'md5' in hash_to_rows:
+      timer.time(
+          'move', create_dup_images_html.maybe_move, hash_to_rows['md5'],
+          image_files, hash_type_to_deduper['md5'], src_root_dir, dst_root_dir
+      )
+
+  results = {
+      'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+      'platform': platform.platform(),
+      'python': platform.python_version(),
+      'settings': {
+          'num_images': num_images,
+          'jobs': jobs,
+          'seed': seed,
+          'hash_types': sorted(hash_type_to_deduper),
+          'thumbnails': bool(thumbnail_dir),
+      },
+      'corpus': corpus_stats,
+      'stages': timer.stages,
+  }
+  utils.dump_json(result_path, results)
+  print(f'\033[93m=> Saved the results to {result_path}\033[0m')
+  return results
+
+
+if __name__ == '__main__':
+  # Compare the json files of two runs to see the effect of a change.
+  result_path = f'/tmp/benchmark_dedup_{time.strftime("%Y%m%d_%H%M%S")}.json'
+  num_images = 500
+  jobs = os.cpu_count()
+  benchmark(result_path, num_images=num_images, jobs=jobs)
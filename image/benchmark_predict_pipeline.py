@@ -0,0 +1,67 @@
+"""Shows the overlap of the decoding and the inference of NudePredictor.run().
+
+The decoding and the detector of a fake predictor sleep, so the speedup of the
+pipeline can be measured without nudenet or images. Sleeping releases the GIL
+like cv2 decoding and onnxruntime inference do. Without overlap, a batch takes
+batch_size * decode_secs / decode_threads + detect time, with overlap it takes
+the max of the two.
+"""
+import dataclasses
+import time
+
+import create_sfw_images_html
+import utils
+
+
+@dataclasses.dataclass(frozen=True)
+class _SleepyDetector:
+  detect_secs: float  # Per image.
+
+  def detect_batch(self, images):
+    time.sleep(self.detect_secs * len(images))
+    return [[] for _ in images]
+
+
+@utils.make_dataclass(frozen=True)
+class SleepyPredictor(create_sfw_images_html.NudePredictor):
+  decode_secs: float = 0.01  # Per image.
+
+  def _decode_image(self, fullpath):
+    time.sleep(self.decode_secs)
+    return fullpath
+
+
+def benchmark(
+    num_images: int = 512,
+    decode_secs: float = 0.01,
+    detect_secs: float = 0.005,
+    detect_batch_size: int = 16,
+):
+  imgs = [f'/fake/{i}.jpg' for i in range(num_images)]
+  print(f'{"mode":<12}{"threads":>8}{"prefetch":>10}{"secs":>8}{"imgs/s":>8}')
+  base_secs = None
+  for mode, decode_threads, prefetch_batches in (
+      ('serial', 1, 0),
+      ('threads', 4, 0),
+      ('pipelined', 4, 2),
+  ):
+    predictor = SleepyPredictor(
+        _detector=_SleepyDetector(detect_secs),
+        decode_threads=decode_threads,
+        prefetch_batches=prefetch_batches,
+        detect_batch_size=detect_batch_size,
+        decode_secs=decode_secs,
+    )
+    start = time.perf_counter()
+    result = predictor.run(imgs)
+    secs = time.perf_counter() - start
+    assert list(result) == imgs
+    base_secs = base_secs or secs
+    print(
+        f'{mode:<12}{decode_threads:>8}{prefetch_batches:>10}{secs:>8.2f}'
+        f'{num_images / secs:>8.1f}  {base_secs / secs:.2f}x'
+    )
+
+
+if __name__ == '__main__':
+  benchmark()
@@ -0,0 +1,89 @@
+"""Compares the full and the reduced resolution decode of DeduperSimhash.
+
+Reports the simhash throughput of both modes, and for each hash type, the
+fraction of images whose hashes are the same in both modes and the mean Hamming
+distance between them.
+"""
+import os
+import time
+
+import create_dup_images_html
+import utils
+
+
+def _load_files(src_root_dir: str, max_files: int):
+  """Reads the files into memory so the benchmark doesn't measure disk IO."""
+  all_file_bytes = {}
+  for cur_path, _, files in os.walk(src_root_dir):
+    for filename in files:
+      fullpath = os.path.join(cur_path, filename)
+      if utils.should_skip(fullpath, os.path.getsize(fullpath)):
+        continue
+      with open(fullpath, 'rb') as f:
+        all_file_bytes[fullpath] = f.read()
+      if len(all_file_bytes) >= max_files:
+        return all_file_bytes
+  return all_file_bytes
+
+
+def _run(deduper, all_file_bytes):
+  start = time.perf_counter()
+  results = {
+      fullpath: deduper.compute_hashes(fullpath, file_bytes)
+      for fullpath, file_bytes in all_file_bytes.items()
+  }
+  return results, time.perf_counter() - start
+
+
+def benchmark(src_root_dir: str, max_files: int = 1000):
+  all_file_bytes = _load_files(src_root_dir, max_files)
+  num_jpegs = sum(
+      utils.sniff_image_format(b) == 'jpeg' for b in all_file_bytes.values()
+  )
+  num_bytes = sum(len(b) for b in all_file_bytes.values())
+  print(
+      f'\033[93m=> Loaded {len(all_file_bytes)} files ({num_jpegs} jpegs), '
+      f'{num_bytes / 2**20:.1f}MB.\033[0m'
+  )
+
+  full_deduper = create_dup_images_html.DeduperSimhash(fast_decode=False)
+  fast_deduper = create_dup_images_html.DeduperSimhash(fast_decode=True)
+  full_results, full_secs = _run(full_deduper, all_file_bytes)
+  fast_results, fast_secs = _run(fast_deduper, all_file_bytes)
+
+  num_files = len(all_file_bytes)
+  print(f'{"mode":<8}{"secs":>10}{"files/s":>10}{"MB/s":>10}')
+  for mode, secs in (('full', full_secs), ('fast', fast_secs)):
+    print(
+        f'{mode:<8}{secs:>10.2f}{num_files / secs:>10.1f}'
+        f'{num_bytes / 2**20 / secs:>10.1f}'
+    )
+  print(f'=> Speedup: {full_secs / fast_secs:.2f}x')
+
+  print(f'{"hash_type":<16}{"same":>8}{"mean_dist":>12}')
+  for cfg in full_deduper.cfgs:
+    full_type = full_deduper.hash_type(cfg)
+    fast_type = fast_deduper.hash_type(cfg)
+    num_same = 0
+    total_dist = 0
+    num_compared = 0
+    for fullpath, full_hashes in full_results.items():
+      fast_hashes = fast_results[fullpath]
+      if full_type not in full_hashes or fast_type not in fast_hashes:
+        continue
+      dist = (full_hashes[full_type] ^ fast_hashes[fast_type])
+      dist = dist.bit_count()
+      num_same += dist == 0
+      total_dist += dist
+      num_compared += 1
+    num_compared = max(num_compared, 1)
+    print(
+        f'{cfg.name:<16}{num_same / num_compared:>8.1%}'
+        f'{total_dist / num_compared:>12.2f}'
+    )
+
+
+if __name__ == '__main__':
+  src_root_dir = '/Users/laigd/Documents/images/eee/网页'
+  max_files = 1000
+  benchmark(src_root_dir, max_files=max_files)
@@ -287,6 +287,174 @@ async function handleDstDir() {
   getDstDirName().innerHTML = 'Chosen dst directory: ' + dirHandle.name;
 }
 
+// Manifest mode: shows the groups of a json manifest written by
+// utils.write_manifest(). The rows have a fixed height, and only the rows in
+// the viewport (plus MANIFEST_OVERSCAN_ROWS above and below) are in the DOM, so
+// a manifest of millions of images is as fast as a small one.
+// Manifests opened from a file need this page to be opened via file:// when
+// they have absolute paths. See loadManifestFromUrl() for manifests over http.
+const MANIFEST_ROW_NAME_HEIGHT = 30;  // Height of the group name and margins.
+const MANIFEST_OVERSCAN_ROWS = 5;
+
+manifest = null;  // The loaded manifest.
+// Url of the manifest when it was fetched, null when it was opened from a file.
+manifestBaseUrl = null;
+// Maps the index of the rendered groups to their row elements.
+manifestRenderedRows = new Map();
+
+function getManifestView() {
+  return elemById('manifest_view');
+}
+function getManifestName() {
+  return elemById('manifest_name');
+}
+
+function manifestRowHeight() {
+  return Math.round(manifest.cell_width * 1.5) + MANIFEST_ROW_NAME_HEIGHT;
+}
+
+// Returns the url of a path of the manifest, or null if it can't be fetched.
+function manifestUrl(path) {
+  if (manifestBaseUrl != null) {
+    // Only the files under the directory of the manifest are served, at urls
+    // relative to the manifest.
+    if (path.startsWith(manifest.root + '/')) {
+      path = path.slice(manifest.root.length + 1);
+    } else if (path.startsWith('/')) {
+      return null;
+    }
+    return new URL(encodePath(path), manifestBaseUrl).href;
+  }
+  if (!path.startsWith('/')) {
+    path = manifest.root + '/' + path;
+  }
+  return encodePath(path);
+}
+
+function encodePath(path) {
+  return path.split('/').map(encodeURIComponent).join('/');
+}
+
+function createManifestRow(i) {
+  const [name, first, count] = manifest.groups[i];
+  const height = manifestRowHeight();
+  let row = document.createElement('div');
+  row.className = 'manifest_row';
+  row.style.top = (i * height) + 'px';
+  row.style.height = height + 'px';
+
+  let nameElem = document.createElement('div');
+  nameElem.className = 'manifest_row_name';
+  nameElem.textContent = `${i}: ${name} (${count} images)`;
+  row.appendChild(nameElem);
+
+  const firstWidth = manifest.files[first][2] || 1;
+  for (let j = first; j < first + count; ++j) {
+    const [path, size, w, h, thumbnail, meta] = manifest.files[j];
+    let width = manifest.cell_width;
+    if (manifest.scale_image_by_width) {
+      width *= (w || 1) / firstWidth;
+    }
+    let img = document.createElement('img');
+    img.className = 'manifest_img';
+    // The thumbnails in a cache dir outside of the manifest's can't be fetched
+    // over http, the originals are shown instead.
+    img.src = (thumbnail && manifestUrl(thumbnail)) || manifestUrl(path);
+    img.width = Math.floor(width);
+    img.style.maxHeight = (height - MANIFEST_ROW_NAME_HEIGHT) + 'px';
+    img.title = `${path}\n${w}x${h}, ${size} bytes`;
+    if (meta != null) {
+      img.title += '\n' + JSON.stringify(meta);
+    }
+    // Opens the original image.
+    let link = document.createElement('a');
+    link.href = manifestUrl(path);
+    link.target = '_blank';
+    link.appendChild(img);
+    row.appendChild(link);
+  }
+  return row;
+}
+
+// Renders the rows in the viewport and removes the others.
+function renderManifestRows() {
+  if (manifest == null) return;
+  const view = getManifestView();
+  const height = manifestRowHeight();
+  const top = window.scrollY - view.offsetTop;
+  const start = Math.max(0, Math.floor(top / height) - MANIFEST_OVERSCAN_ROWS);
+  const end = Math.min(
+      manifest.groups.length,
+      Math.ceil((top + window.innerHeight) / height) + MANIFEST_OVERSCAN_ROWS);
+
+  for (const [i, row] of manifestRenderedRows) {
+    if (i < start || i >= end) {
+      row.remove();
+      manifestRenderedRows.delete(i);
+    }
+  }
+  for (let i = start; i < end; ++i) {
+    if (!manifestRenderedRows.has(i)) {
+      const row = createManifestRow(i);
+      view.appendChild(row);
+      manifestRenderedRows.set(i, row);
+    }
+  }
+}
+
+// Re-renders at most once per frame while scrolling.
+renderManifestPending = false;
+function scheduleRenderManifestRows() {
+  if (renderManifestPending) return;
+  renderManifestPending = true;
+  window.requestAnimationFrame(() => {
+    renderManifestPending = false;
+    renderManifestRows();
+  });
+}
+
+function loadManifest(text, name, baseUrl = null) {
+  manifest = JSON.parse(text);
+  manifestBaseUrl = baseUrl;
+  if (manifest.version != 1) {
+    showError('Unsupported manifest version: ' + manifest.version);
+  }
+  getImgTable().innerHTML = '';
+  let view = getManifestView();
+  view.innerHTML = '';
+  manifestRenderedRows.clear();
+  view.style.height = (manifest.groups.length * manifestRowHeight()) + 'px';
+  getManifestName().textContent =
+      `${name}: ${manifest.groups.length} groups, ` +
+      `${manifest.files.length} images`;
+  window.scrollTo(0, 0);
+  renderManifestRows();
+}
+
+async function handleManifestFile(event) {
+  const file = event.target.files[0];
+  if (file) {
+    loadManifest(await file.text(), file.name);
+  }
+}
+
+// Loads the manifest given by the 'manifest' url parameter, if any. This only
+// works when the page is served over http, browsers don't fetch file:// urls.
+// The images are then fetched relative to the url of the manifest, so the
+// server needs to serve the directory of the manifest, e.g.
+// main.html?manifest=/lib/image_mapping_md5.manifest.json
+async function loadManifestFromUrl() {
+  const url = new URLSearchParams(window.location.search).get('manifest');
+  if (url) {
+    const response = await fetch(url);
+    if (!response.ok) {
+      showError(`Failed to fetch ${url}: ${response.status}`);
+    }
+    loadManifest(
+        await response.text(), url, new URL(url, window.location.href).href);
+  }
+}
+
 function addEventListener(id, eventName, handler) {
   let elem = elemById(id);
   elem.addEventListener(eventName, handler, false);
@@ -295,4 +463,8 @@ function addEventListener(id, eventName, handler) {
 window.onload = function() {
   addEventListener('src_dir', 'click', handleSrcDir)
   addEventListener('dst_dir', 'click', handleDstDir)
+  addEventListener('manifest_file', 'change', handleManifestFile)
+  window.addEventListener('scroll', scheduleRenderManifestRows, false);
+  window.addEventListener('resize', scheduleRenderManifestRows, false);
+  loadManifestFromUrl();
 };
@@ -1,3 +1,4 @@
+import concurrent.futures
 import os
 import random
 import re
@@ -5,11 +6,18 @@ import shutil
 import string
 from PIL import Image
 
+import file_manifest
 import utils
 
 
-def fake_move_fn(src, dst):
-  print(f'\033[93m=> {src}\033[0m')
+def _verify_image(src_path: str) -> str | None:
+  """Fully verifies an image, returns 'invalid' or None if it's valid."""
+  try:
+    with Image.open(src_path) as img:
+      img.verify()  # Verify that it's a valid image
+  except (IOError, OSError):  # Handle cases where PIL can't open the file as an image
+    return 'invalid'
+  return None
 
 
 def cleanup_images(
@@ -18,89 +26,172 @@ def cleanup_images(
         size_threshold=20 * 1024,
         delete_regex_patterns=None,
         keep_dir_structture=True,
+        full_verify=False,
+        jobs=None,
+        dry_run=False,
+        profile_path=None,
+        use_manifest=True,
+        full_scan=False,
 ):  # size in bytes
   """Walks through a directory and moves files that meet certain criteria.
 
+  Files are moved when they are smaller than size_threshold, or their name
+  matches a regex, or they are not images. Whether a file is an image is checked
+  in tiers, each one more expensive:
+  1. The magic bytes of common formats are sniffed from the head of the file,
+     and the size is parsed from the header. Only the head is read.
+  2. Files with unknown magic bytes are opened by PIL, which only parses the
+     header.
+  3. When full_verify is set, the files that passed the above are fully read
+     and verified by PIL in a pool of worker processes, to also find truncated
+     or corrupted images.
+
   Args:
     src_root_dir: The path to the source directory.
     dst_root_dir: The path to the destination directory.
     size_threshold: The size threshold in bytes (default: 20KB).
     regex_pattern: Regular expression patterns to match filenames (optional).
+    full_verify: Whether to fully verify the images, see above.
+    jobs: Number of processes to verify the images, defaults to the number of
+      CPUs.
+    dry_run: When set, nothing is moved, the files to move are only printed.
+    profile_path: Where to save the time of each stage as json (optional), see
+      utils.Profiler.
+    use_manifest: Whether to list the files with the persistent manifest of
+      src_root_dir, see file_manifest.scan_files().
+    full_scan: Whether to list all directories again, to pick up the sizes of
+      the files modified in place, see file_manifest.scan_files().
+
+  Returns:
+    {src_path: reason} of the files moved, or to move when dry_run is set. The
+    reason is one of 'small', 'regex', 'not_image' or 'invalid'.
   """
 
-  if not os.path.exists(dst_root_dir):
+  if not dry_run and not os.path.exists(dst_root_dir):
     os.makedirs(dst_root_dir)
 
   regexes = [re.compile(p) for p in (delete_regex_patterns or ())]
-  move_fn = utils.safe_move
-  # move_fn = fake_move_fn
-
-  for cur_path, _, files in os.walk(src_root_dir):
-    for filename in files:
-      if utils.should_skip(filename):
+  profiler = utils.Profiler('cleanup', enabled=bool(profile_path))
+  # {src_path: (dst_path, reason)} of the files to move.
+  to_move = {}
+  # (src_path, dst_path) of the images to fully verify.
+  to_verify = []
+
+  with utils.profiling(profiler):
+    entries = file_manifest.scan_files(
+        src_root_dir, use_manifest, full_scan
+    )
+  profiler.total = len(entries)
+  for entry in entries:
+    profiler.progress()
+    src_path = entry.path
+    filename = os.path.basename(src_path)
+    if utils.should_skip(src_path):
+      profiler.count('skipped_files')
+      continue
+
+    if keep_dir_structture:
+      relative_path = os.path.relpath(src_path, src_root_dir)
+      dst_path = os.path.join(dst_root_dir, relative_path)
+    else:
+      # Use a random file name to avoid overwriting the same file.
+      suffix = ''.join(random.choices(
+          string.ascii_letters + string.digits, k=16))
+      parts = filename.split('.')
+      name = '.'.join(parts[:-1])
+      ext = parts[-1]
+      dst_path = os.path.join(dst_root_dir, f'{name}.{suffix}.{ext}')
+
+    try:
+      # Check file size, known from the scan.
+      if entry.size < size_threshold:
+        to_move[src_path] = (dst_path, 'small')
+        continue  # Move to the next file if size condition is met
+
+      # Regex check (if provided)
+      if any(r.match(filename) for r in regexes):
+        to_move[src_path] = (dst_path, 'regex')
         continue
 
-      src_path = os.path.join(cur_path, filename)
-
-      if keep_dir_structture:
-        relative_path = os.path.relpath(src_path, src_root_dir)
-        dst_dir = os.path.join(dst_root_dir, os.path.dirname(relative_path))
-        if not os.path.exists(dst_dir):
-          os.makedirs(dst_dir)
-        dst_path = os.path.join(dst_dir, filename)
-      else:
-        # Use a random file name to avoid overwriting the same file.
-        suffix = ''.join(random.choices(
-            string.ascii_letters + string.digits, k=16))
-        parts = filename.split('.')
-        name = '.'.join(parts[:-1])
-        ext = parts[-1]
-        dst_path = os.path.join(dst_root_dir, f'{name}.{suffix}.{ext}')
-
-      try:
-        # Check file size
-        if os.path.getsize(src_path) < size_threshold:
-          move_fn(src_path, dst_path)
-          continue  # Move to the next file if size condition is met
-
-        # Regex check (if provided)
-        moved = False
-        for r in regexes:
-          if r.match(filename):
-            move_fn(src_path, dst_path)
-            moved = True
-            break  # Move if regex matches
-        if moved:
-          continue
-
-        # Check if it's an image. If it is, check dimensions or other image-specific criteria
+      # Files whose header can't be parsed are not images, no need to verify.
+      with profiler.stage('probe_size'):
+        image_size = utils.probe_image_size(src_path)
+      if image_size is None:
+        to_move[src_path] = (dst_path, 'not_image')
+        continue
+      if full_verify:
+        to_verify.append((src_path, dst_path))
+
+    except Exception as e:  # Catch general errors
+      print(f"Error processing {src_path}: {e}")
+      profiler.count('errors')
+
+  if to_verify:
+    with profiler.stage('verify'), concurrent.futures.ProcessPoolExecutor(
+        jobs
+    ) as executor:
+      src_paths = [src_path for src_path, _ in to_verify]
+      futures = [executor.submit(_verify_image, p) for p in src_paths]
+      for (src_path, dst_path), future in zip(to_verify, futures):
         try:
-          img = Image.open(src_path)
-          img.verify()  # Verify that it's a valid image
-          img.close()
-        except (IOError, OSError) as e:  # Handle cases where PIL can't open the file as an image
-          move_fn(src_path, dst_path)
+          reason = future.result()
+        except Exception as e:  # Catch general errors
+          print(f"Error processing {src_path}: {e}")
+          profiler.count('errors')
           continue
-
-      except Exception as e:  # Catch general errors
-        print(f"Error processing {src_path}: {e}")
-
-
-# To run:
-# vadjx
-# python cleanup.py
-cleanup_images(
-    src_root_dir='/Users/laigd/Documents/images/eee/网页/74',
-    # src_root_dir='/Users/laigd/.Trash/1',
-    dst_root_dir='/Users/laigd/.Trash/2',
-    size_threshold=20 * 1024,
-    delete_regex_patterns=(
-        # Don't remove gif! Small gif should be handled by size-based rule!
-        # r'.*\.gif$',
-        r'.*_avatar_.*\.jpg$',
-        r'.*\.php$',
-        r'^js(.[123].)?$',
-        r'^f(\(1\))?\.txt$',
-    ),
-    keep_dir_structture=False,
-)
+        if reason:
+          to_move[src_path] = (dst_path, reason)
+
+  for _, reason in to_move.values():
+    profiler.count(f'to_move_{reason}')
+
+  if dry_run:
+    for src_path, (_, reason) in to_move.items():
+      print(f'\033[93m=> Would move ({reason}) {src_path}\033[0m')
+  else:
+    # The moves are journaled, see move_with_structure.undo_moves() to move them
+    # back.
+    mover = utils.BulkMover(
+        journal_path=os.path.join(dst_root_dir, utils.MOVE_JOURNAL_NAME)
+    )
+    for src_path, (dst_path, _) in to_move.items():
+      mover.add(src_path, dst_path)
+    # Files already existing in dst_root_dir are reported and left in place.
+    with utils.profiling(profiler):
+      moved = {src_path for src_path, _ in mover.run(on_collision='skip')}
+    to_move = {
+        src_path: dst_reason
+        for src_path, dst_reason in to_move.items()
+        if src_path in moved
+    }
+
+  profiler.print_summary()
+  if profile_path:
+    profiler.dump(profile_path)
+  return {src_path: reason for src_path, (_, reason) in to_move.items()}
+
+
+if __name__ == '__main__':
+  # To run:
+  # vadjx
+  # python cleanup.py
+  cleanup_images(
+      src_root_dir='/Users/laigd/Documents/images/eee/网页/74',
+      # src_root_dir='/Users/laigd/.Trash/1',
+      dst_root_dir='/Users/laigd/.Trash/2',
+      size_threshold=20 * 1024,
+      delete_regex_patterns=(
+          # Don't remove gif! Small gif should be handled by size-based rule!
+          # r'.*\.gif$',
+          r'.*_avatar_.*\.jpg$',
+          r'.*\.php$',
+          r'^js(.[123].)?$',
+          r'^f(\(1\))?\.txt$',
+      ),
+      keep_dir_structture=False,
+      # Set to print the files to move without moving them.
+      dry_run=False,
+      # Set to list all directories again, to pick up the files modified in
+      # place, which the manifest misses.
+      full_scan=False,
+  )
@@ -1,16 +1,22 @@
 import abc
 import base64
 import collections
+import concurrent.futures
 import dataclasses
 import hashlib
 import json
 import os
+import sqlite3
 import typing
+from typing import Any, Sequence
 
 import cv2
 import numpy as np
-from PIL import Image
 
+import external_groups
+import file_manifest
+import hash_store as hash_store_lib
+import simhash_index
 import utils
 
 
@@ -22,11 +28,17 @@ class Deduper(typing.Protocol):
     ...
 
   @abc.abstractmethod
-  def compute_hashes(self, file_path: str, file_bytes: bytes) -> dict[str, str]:
+  def compute_hashes(self, file_path: str,
+                     file_bytes: bytes) -> dict[str, str | int]:
     ...
 
+  def is_cached_hash_valid(self, hash_val) -> bool:
+    """Whether a hash value loaded from the hash file can be reused."""
+    return True
+
   @abc.abstractmethod
-  def key_fn(self, file: utils.ImageFileMeta):
+  def key_fn(self, files: utils.FileTable, row: int):
+    """Sort key of the file at row, the first file of a group is kept."""
     ...
 
 
@@ -37,22 +49,111 @@ def compute_md5(file_bytes: bytes):
   return hash_md5.hexdigest()
 
 
+def _head_tail_md5(file_path: str, size: int, num_bytes: int):
+  """MD5 of the first and the last num_bytes of the file.
+
+  Returns (md5, is_full), where is_full tells whether the whole file was read,
+  i.e. md5 is the MD5 of the file.
+  """
+  hash_md5 = hashlib.md5()
+  with open(file_path, 'rb') as f:
+    if size <= 2 * num_bytes:
+      hash_md5.update(f.read())
+      return hash_md5.hexdigest(), True
+    hash_md5.update(f.read(num_bytes))
+    f.seek(size - num_bytes)
+    hash_md5.update(f.read(num_bytes))
+  return hash_md5.hexdigest(), False
+
+
 class DeduperMd5(Deduper):
 
+  def __init__(self, staged: bool = False, head_tail_bytes: int = 4096):
+    """Creates the deduper.
+
+    Args:
+      staged: When set, compute_hashes() is not used. Instead staged_md5s()
+        only hashes the files that may have an identical copy, see there.
+      head_tail_bytes: Number of bytes to hash at each end of a file in the
+        partial stage of staged_md5s().
+    """
+    self.staged = staged
+    self.head_tail_bytes = head_tail_bytes
+
   def hash_types(self):
     return ('md5',)
 
+  def staged_md5s(
+      self, files: list[tuple[str, int]], cached_md5s: dict[str, str]
+  ) -> dict[str, str]:
+    """Computes the MD5s of the files that may have an identical copy.
+
+    1. Files with a unique size can't have an identical copy, skip them.
+    2. Hash the first and last head_tail_bytes of the files with the same size,
+       and skip the files whose (size, partial hash) is unique.
+    3. Fully hash the remaining files.
+
+    Args:
+      files: (fullpath, size) of all files.
+      cached_md5s: Known MD5s by fullpath, these files are never fully read.
+
+    Returns:
+      {fullpath: md5} of the cached files and the files fully hashed in step 3.
+      The other files can't have an identical copy.
+    """
+    md5s = dict(cached_md5s)
+    size_to_paths = collections.defaultdict(list)
+    for fullpath, size in files:
+      size_to_paths[size].append(fullpath)
+
+    num_partial = num_full = 0
+    for size, paths in size_to_paths.items():
+      if len(paths) < 2 or all(p in md5s for p in paths):
+        continue
+      partial_to_paths = collections.defaultdict(list)
+      for fullpath in paths:
+        try:
+          partial_to_paths[_head_tail_md5(
+              fullpath, size, self.head_tail_bytes
+          )].append(fullpath)
+          num_partial += 1
+        except Exception as e:
+          print(f'\033[91m=> Failed to read {fullpath}: {e}\033[0m')
+      for (partial_md5, is_full), same_paths in partial_to_paths.items():
+        if len(same_paths) < 2:
+          continue
+        for fullpath in same_paths:
+          if fullpath in md5s:
+            continue
+          if is_full:
+            md5s[fullpath] = partial_md5
+            continue
+          try:
+            md5s[fullpath] = utils.md5_of_file(fullpath)
+            num_full += 1
+          except Exception as e:
+            print(f'\033[91m=> Failed to compute md5 of {fullpath}: {e}\033[0m')
+    print(
+        f'\033[93m=> Staged md5: {len(files)} files, {num_partial} partially '
+        f'hashed, {num_full} fully hashed.\033[0m'
+    )
+    profiler = utils.current_profiler()
+    profiler.count('md5_partially_hashed', num_partial)
+    profiler.count('md5_fully_hashed', num_full)
+    return md5s
+
   def compute_hashes(self, file_path: str, file_bytes: bytes):
     hashes = {}
     try:
-      md5 = compute_md5(file_bytes)
+      with utils.current_profiler().stage('md5'):
+        md5 = compute_md5(file_bytes)
       hashes['md5'] = md5
     except Exception as e:
       print(f'\033[91m=> Failed to compute md5 of {file_path}: {e}\033[0m')
     return hashes
 
-  def key_fn(self, file: utils.ImageFileMeta):
-    return file.relative_path
+  def key_fn(self, files: utils.FileTable, row: int):
+    return files.relative_path(row)
 
 
 @dataclasses.dataclass(frozen=True, kw_only=True)
@@ -69,10 +170,72 @@ class SimhashConfig:
   def gscale(self) -> int:
     return 2**self.gscale_bits
 
+  @property
+  def num_bits(self) -> int:
+    return self.tsize**2 * self.gscale_bits
+
+  @property
+  def num_bytes(self) -> int:
+    return (self.num_bits + 7) // 8
+
+
+def _simhash_bits(img: np.ndarray, cfg: SimhashConfig) -> np.ndarray:
+  """Quantizes the thumbnail to cfg.gscale levels and returns its bits.
+
+  The bits of each pixel are in MSB first order, e.g. 8x8 with 4 grayscale will
+  be converted to 128 bits. The result is left padded with 0s to whole bytes,
+  so np.packbits() of it gives the big endian bytes of the hash.
+  """
+  # Convert to 4-level grayscale (0, 64, 128, 192)
+  # img = img // 64
+  m1 = int(img.min())
+  m2 = int(img.max())
+  step = (m2 - m1) // cfg.gscale
+  if step == 0:  # Low contrast image.
+    levels = np.zeros(img.size, np.uint8)
+  else:
+    # The brightest pixels would be quantized to cfg.gscale, clip them so each
+    # pixel fits in gscale_bits.
+    levels = np.minimum((img.ravel() - m1) // step, cfg.gscale - 1)
+    levels = levels.astype(np.uint8)
+
+  shifts = np.arange(cfg.gscale_bits - 1, -1, -1, dtype=np.uint8)
+  bits = ((levels[:, None] >> shifts) & 1).ravel().astype(np.uint8)
+  return np.concatenate(
+      (np.zeros(cfg.num_bytes * 8 - cfg.num_bits, np.uint8), bits)
+  )
 
-class DeduperSimhash:
 
-  def __init__(self):
+# JPEGs can be decoded at 1/2, 1/4 or 1/8 of their resolution by scaling the
+# DCT, which skips most of the decoding work.
+_REDUCED_GRAYSCALE_FLAGS = (
+    (8, cv2.IMREAD_REDUCED_GRAYSCALE_8),
+    (4, cv2.IMREAD_REDUCED_GRAYSCALE_4),
+    (2, cv2.IMREAD_REDUCED_GRAYSCALE_2),
+)
+# Min size of the shorter side of a reduced image, so it's still at least 4x of
+# the largest thumbnail.
+_MIN_REDUCED_SIDE = 32
+
+
+class DeduperSimhash(Deduper):
+
+  def __init__(
+      self,
+      fast_decode: bool = False,
+      hash_types: Sequence[str] | None = None,
+  ):
+    """Creates the deduper.
+
+    Args:
+      fast_decode: Whether to decode JPEGs at a reduced resolution, see
+        benchmark_simhash_decode.py for the speedup and the hash agreement with
+        the full resolution decode. The hashes of this mode often differ, so
+        they have their own hash types, see hash_type().
+      hash_types: Names of the configs to compute, all of them if None. Either
+        SimhashConfig.name or hash_type().
+    """
+    self.fast_decode = fast_decode
     # yapf: disable
     self.cfgs = [
         SimhashConfig(tsize=tsize, gscale_bits=gscale_bits)
@@ -82,181 +245,694 @@ class DeduperSimhash:
         )
     ]
     # yapf: enable
+    if hash_types is not None:
+      known_types = {cfg.name for cfg in self.cfgs} | set(self.hash_types())
+      unknown_types = set(hash_types) - known_types
+      assert not unknown_types, f'Unknown simhash types: {unknown_types}'
+      self.cfgs = [
+          cfg for cfg in self.cfgs
+          if cfg.name in hash_types or self.hash_type(cfg) in hash_types
+      ]
 
   def hash_types(self):
-    return tuple(cfg.name for cfg in self.cfgs)
+    return tuple(self.hash_type(cfg) for cfg in self.cfgs)
+
+  def hash_type(self, cfg: SimhashConfig) -> str:
+    """The hash type of the config, e.g. simhash64x4, or simhash64x4-fast.
+
+    The hashes of fast_decode are cached and reported under their own types,
+    so switching the mode of a library never mixes the hashes of both modes.
+    """
+    return f'{cfg.name}-fast' if self.fast_decode else cfg.name
 
   def compute_hashes(self, file_path: str, file_bytes: bytes):
     hashes = {}
+    profiler = utils.current_profiler()
     try:
       # img = cv2.imread(file_path, cv2.IMREAD_GRAYSCALE)
-      nparr = np.frombuffer(file_bytes, np.uint8)
-      orimg = cv2.imdecode(nparr, cv2.IMREAD_GRAYSCALE)
+      with profiler.stage('decode'):
+        nparr = np.frombuffer(file_bytes, np.uint8)
+        orimg = cv2.imdecode(nparr, self._decode_flags(file_path, file_bytes))
       if orimg is None:
         raise ValueError(f"Could not read image from: {file_path}")
 
-      for cfg in self.cfgs:
-        img = cv2.resize(orimg, (cfg.tsize, cfg.tsize))
-
-        # Convert to 4-level grayscale (0, 64, 128, 192)
-        # img = img // 64
-        m1 = np.min(img)
-        m2 = np.max(img)
-        img = (img - m1) // ((m2 - m1) // cfg.gscale)
-
-        # Convert the NxN matrix to a binary string. E.g. 8x8 with 4 grayscale
-        # will be converted to 128bit binary string.
-        binary_string = ''.join(
-            format(i, f'0{cfg.gscale_bits}b') for i in img.flatten()
-        )
-        integer_representation = int(binary_string, 2)
-        hashes[cfg.name] = hex(integer_representation)
+      with profiler.stage('simhash'):
+        # Configs with the same thumbnail size share the resized image.
+        thumbnails = {}
+        all_bits = []
+        for cfg in self.cfgs:
+          if cfg.tsize not in thumbnails:
+            thumbnails[cfg.tsize] = cv2.resize(orimg, (cfg.tsize, cfg.tsize))
+          all_bits.append(_simhash_bits(thumbnails[cfg.tsize], cfg))
+
+        # Every config is padded to whole bytes, so they can be packed together
+        # and sliced back by their byte sizes.
+        packed = np.packbits(np.concatenate(all_bits)).tobytes()
+        offset = 0
+        for cfg in self.cfgs:
+          hashes[self.hash_type(cfg)] = int.from_bytes(
+              packed[offset:offset + cfg.num_bytes], 'big'
+          )
+          offset += cfg.num_bytes
     except Exception as e:
       print(f'\033[91m=> Failed to simhash {file_path}: {e}\033[0m')
     return hashes
 
-  def key_fn(self, file: utils.ImageFileMeta):
-    return -file.w, -file.h, -file.size, file.relative_path
+  def _decode_flags(self, file_path: str, file_bytes: bytes) -> int:
+    if not self.fast_decode or utils.sniff_image_format(file_bytes) != 'jpeg':
+      return cv2.IMREAD_GRAYSCALE
+    image_size = utils.probe_image_size(file_path, file_bytes)
+    if image_size is None:
+      return cv2.IMREAD_GRAYSCALE
+    min_side = min(image_size)
+    for scale, flags in _REDUCED_GRAYSCALE_FLAGS:
+      if min_side // scale >= _MIN_REDUCED_SIDE:
+        return flags
+    return cv2.IMREAD_GRAYSCALE
+
+  def is_cached_hash_valid(self, hash_val) -> bool:
+    # Hashes used to be saved as hex strings, and a pixel could overflow its
+    # gscale_bits, so they are not comparable with the current ones.
+    return isinstance(hash_val, int)
+
+  def key_fn(self, files: utils.FileTable, row: int):
+    return (
+        -files.w[row], -files.h[row], -files.size[row],
+        files.relative_path(row)
+    )
 
 
 def maybe_move(
-    hash_to_metas: dict[str, list[utils.ImageFileMeta]],
+    hash_to_rows: dict[str, list[int]],
+    files: utils.FileTable,
     deduper: Deduper,
     src_root_dir: str,
     dst_root_dir: str | None,
 ):
-  for files in hash_to_metas.values():
-    files.sort(key=deduper.key_fn)
+  """Sorts the groups by deduper.key_fn, and moves all but the first files.
+
+  hash_to_rows maps a hash value to the row ids of its files in files. The
+  groups are sorted in place, and a moved file is replaced by a new row with its
+  new path, so the groups of the other hash types are unchanged. Returns
+  hash_to_rows.
+  """
+  sort_key = lambda row: deduper.key_fn(files, row)
+  for rows in hash_to_rows.values():
+    if len(rows) > 1:
+      rows.sort(key=sort_key)
 
   if not dst_root_dir:
-    return hash_to_metas
+    return hash_to_rows
 
   if not os.path.exists(dst_root_dir):
     os.makedirs(dst_root_dir)
 
-  updated_hash_to_metas = {}
-  for key, files in hash_to_metas.items():
-    moved_files = [files[0]]  # This is the best file, don't move it.
-    for file in files[1:]:
-      dst_path = utils.move_with_roots(
-          src_root_dir, dst_root_dir, file.relative_path
+  # The best file of each group is not moved. All the others are moved at once,
+  # and nothing is moved if any of them already exists in dst_root_dir. The
+  # moves are journaled, see move_with_structure.undo_moves() to move them back.
+  mover = utils.BulkMover(
+      journal_path=os.path.join(dst_root_dir, utils.MOVE_JOURNAL_NAME)
+  )
+  for rows in hash_to_rows.values():
+    for row in rows[1:]:
+      relative_path = files.relative_path(row)
+      mover.add(
+          os.path.join(src_root_dir, relative_path),
+          os.path.join(dst_root_dir, relative_path),
       )
-      moved_files.append(dataclasses.replace(file, relative_path=dst_path))
+  moved_dsts = {src: dst for src, dst in mover.run()}
+
+  for rows in hash_to_rows.values():
+    for i in range(1, len(rows)):
+      row = rows[i]
+      src_path = os.path.join(src_root_dir, files.relative_path(row))
+      if src_path in moved_dsts:
+        rows[i] = files.append(
+            moved_dsts[src_path], files.size[row], files.w[row], files.h[row]
+        )
+  return hash_to_rows
 
-    updated_hash_to_metas[key] = moved_files
-  return updated_hash_to_metas
 
+def _path_file_key(fullpath: str, size: int) -> str:
+  """Key of the file before file_manifest.FileEntry.cache_key.
 
-def compute_hashes(
-    src_root_dir: str, hash_type_to_deduper: dict[str, Deduper],
-    file_key_to_hash_loaded: dict[str, dict[str, str]]
+  Only used to find the entries cached under it, see _get_cached_hashes().
+  """
+  return f'{fullpath.encode("utf-8")}:{size}'
+
+
+def _iter_files(
+    src_root_dir: str, use_manifest: bool = True, full_scan: bool = False
 ):
-  """Compute the hash values for all known hash types."""
-  # Maps hash_type to {(file_path, file_size): hash_value}
-  file_key_to_hash_new = collections.defaultdict(dict)
-  # Maps hash_type to {hash_value: list[ImageFileMeta]}
-  hash_to_metas = collections.defaultdict(lambda: collections.defaultdict(list))
-
-  num_processed = 0
-  for cur_path, _, files in os.walk(src_root_dir):
-    for filename in files:
-      num_processed += 1
-      if num_processed % 1000 == 0:
-        print(f'\033[93m=> Processed {num_processed} files.\033[0m')
-
-      fullpath = os.path.join(cur_path, filename)
-      size = os.path.getsize(fullpath)
-      if utils.should_skip(fullpath, size):
+  """Returns an iterator of the file_manifest.FileEntry of the files to hash.
+
+  The files are re-statted, so their cache_key is current even if they were
+  modified in place. See file_manifest.scan_files() for use_manifest and
+  full_scan. The total of the current profiler is set to the number of files
+  found, for the ETA.
+  """
+  profiler = utils.current_profiler()
+  entries = file_manifest.scan_files(src_root_dir, use_manifest, full_scan)
+  profiler.total = len(entries)
+
+  def iter_entries():
+    for entry in entries:
+      with profiler.stage('restat'):
+        current_entry = entry.restat()
+      if current_entry is None:
         continue
-
-      # Add file size to key to reduce the chance of collisions when loading the
-      # hash file after an image is removed and a new image is added with the
-      # same name.
-      key = f'{fullpath.encode("utf-8")}:{size}'
-      # Get from loaded or {}.
-      hash_values = file_key_to_hash_loaded.get(key, {})
-      file_bytes = open(fullpath, 'rb').read()
-      failed_dedupers = []  # Avoid running the same deduper multiple times.
-
-      for hash_type, deduper in hash_type_to_deduper.items():
-        if deduper in failed_dedupers:
-          continue
-        if hash_type not in hash_values:
-          # print(f'\033[93m=> Handling type {hash_type} for {fullpath}\033[0m')
-          hashes = deduper.compute_hashes(fullpath, file_bytes)
-          if hashes:
-            hash_values.update(hashes)
-          else:
-            failed_dedupers.append(deduper)
-
-      file_key_to_hash_new[key] = hash_values
-
-      if len(hash_values) != len(hash_type_to_deduper):
-        # Skip if failed to get all hashes, maybe non image.
+      if current_entry is not entry:
+        profiler.count('modified_in_place')
+        entry = current_entry
+      if utils.should_skip(entry.path, entry.size):
+        profiler.count('skipped_files')
         continue
+      yield entry
+
+  return iter_entries()
+
+
+def _get_cached_hashes(
+    hash_store: hash_store_lib.HashStore, entry: file_manifest.FileEntry
+) -> tuple[dict[str, Any], bool]:
+  """Returns the cached hash values of the file, and whether its key changed.
+
+  The entry cached under the path key of the file, by older versions, is moved
+  to entry.cache_key first.
+  """
+  loaded = hash_store.get(entry.cache_key)
+  if loaded:
+    return loaded, False
+  if hash_store.rewrite_key(
+      _path_file_key(entry.path, entry.size), entry.cache_key
+  ):
+    return hash_store.get(entry.cache_key), True
+  return {}, False
+
+
+def _valid_cached_hashes(
+    loaded: dict[str, Any], hash_type_to_deduper: dict[str, Deduper]
+) -> dict[str, Any]:
+  """Returns the loaded hash values which can be reused.
+
+  The hash types not asked for are kept, so they are not lost when writing back
+  to the cache.
+  """
+  return {
+      hash_type: hash_val for hash_type, hash_val in loaded.items()
+      if hash_type not in hash_type_to_deduper
+      or hash_type_to_deduper[hash_type].is_cached_hash_valid(hash_val)
+  }
+
+
+def _hash_file(
+    fullpath: str,
+    hash_values: dict[str, str | int],
+    hash_type_to_deduper: dict[str, Deduper],
+    content_store: hash_store_lib.HashStore | None = None,
+):
+  """Computes the missing hashes and the image size of a single file.
+
+  When content_store is set and some hashes are missing, the hash values of a
+  file with the same md5 are looked up there first. It's for the files not in
+  the cache under their key, e.g. copies, or files moved from another file
+  system. The md5 is only computed for the lookup if it's one of the hash types
+  to compute, otherwise only a known md5, e.g. from the staged md5s, is used.
+
+  Returns the updated hash_values, and the (width, height) of the image or None
+  if not all hashes could be computed or the file is not a valid image.
+  """
+  profiler = utils.current_profiler()
+  file_bytes = None
+  failed_dedupers = []  # Avoid running the same deduper multiple times.
+
+  if content_store is not None and any(
+      hash_type not in hash_values for hash_type in hash_type_to_deduper
+  ):
+    md5 = hash_values.get('md5')
+    if md5 is None and 'md5' in hash_type_to_deduper:
+      with profiler.stage('read'), open(fullpath, 'rb') as f:
+        file_bytes = f.read()
+      profiler.count('bytes_read', len(file_bytes))
+      with profiler.stage('md5'):
+        md5 = hash_values['md5'] = compute_md5(file_bytes)
+    if md5 is not None:
+      with profiler.stage('content_get'):
+        try:
+          cached = content_store.get_by_content(md5)
+        except sqlite3.Error as e:
+          # Only an optimization, compute the hashes instead.
+          print(f'\033[91m=> Failed to look up {fullpath} by md5: {e}\033[0m')
+          cached = {}
+      if cached:
+        profiler.count('content_hits')
+        hash_values = {
+            **_valid_cached_hashes(cached, hash_type_to_deduper),
+            **hash_values
+        }
 
-      try:
-        with Image.open(fullpath) as img:
-          width, height = img.size
-      except Exception as e:
-        print(f'\033[91m=> Failed to get image size for {fullpath}\033[0m')
-        continue
+  for hash_type, deduper in hash_type_to_deduper.items():
+    if deduper in failed_dedupers:
+      continue
+    if hash_type not in hash_values:
+      # print(f'\033[93m=> Handling type {hash_type} for {fullpath}\033[0m')
+      if file_bytes is None:
+        with profiler.stage('read'), open(fullpath, 'rb') as f:
+          file_bytes = f.read()
+        profiler.count('bytes_read', len(file_bytes))
+      hashes = deduper.compute_hashes(fullpath, file_bytes)
+      if hashes:
+        hash_values.update(hashes)
+      else:
+        failed_dedupers.append(deduper)
+
+  if any(hash_type not in hash_values for hash_type in hash_type_to_deduper):
+    # Skip if failed to get all hashes, maybe non image.
+    return hash_values, None
+
+  # Parse the size from the bytes already read, if any. Otherwise only the
+  # header is read.
+  with profiler.stage('probe_size'):
+    image_size = utils.probe_image_size(fullpath, file_bytes)
+  if image_size is None:
+    print(f'\033[91m=> Failed to get image size for {fullpath}\033[0m')
+  return hash_values, image_size
+
+
+# Dedupers of the current worker process. Set once by _init_hash_worker() so
+# they are not pickled with every file.
+_worker_hash_type_to_deduper = None
+# Measures the worker's stages, sent back with the result of each file.
+_worker_profiler = None
+# Read-only connection to the hash store, for the content lookups.
+_worker_content_store = None
+
+
+def _init_hash_worker(
+    hash_type_to_deduper: dict[str, Deduper], profile: bool,
+    store_path: str | None
+):
+  global _worker_hash_type_to_deduper, _worker_profiler, _worker_content_store
+  _worker_hash_type_to_deduper = hash_type_to_deduper
+  _worker_profiler = utils.Profiler(
+      'hash_worker', enabled=profile, progress_every=0
+  )
+  if store_path:
+    try:
+      _worker_content_store = hash_store_lib.HashStore(
+          store_path, read_only=True
+      )
+    except sqlite3.Error as e:
+      print(f'\033[91m=> Failed to open {store_path}: {e}\033[0m')
 
-      relative_path = os.path.relpath(fullpath, src_root_dir)
-      for hash_type, hash_val in hash_values.items():
-        hash_to_metas[hash_type][hash_val].append(
-            utils.ImageFileMeta(
-                relative_path=relative_path, size=size, w=width, h=height
-            )
-        )
-  return file_key_to_hash_new, hash_to_metas
 
+def _hash_file_in_worker(
+    fullpath: str, hash_values: dict[str, str | int], lookup_content: bool
+):
+  """Returns the results of _hash_file() and a profiler snapshot or None."""
+  with utils.profiling(_worker_profiler):
+    hash_values, image_size = _hash_file(
+        fullpath, hash_values, _worker_hash_type_to_deduper,
+        _worker_content_store if lookup_content else None
+    )
+  snapshot = None
+  if _worker_profiler.enabled:
+    snapshot = _worker_profiler.take_snapshot()
+  return hash_values, image_size, snapshot
 
-def dedup_files(
+
+def compute_hashes(
     src_root_dir: str,
-    dst_root_dir: str | None,
-    hash_type_to_move: str | None = None
+    hash_type_to_deduper: dict[str, Deduper],
+    hash_store: hash_store_lib.HashStore,
+    jobs: int = 1,
+    max_files_in_flight: int | None = None,
+    profiler: utils.Profiler | None = None,
+    use_manifest: bool = True,
+    grouper: external_groups.ExternalGrouper | None = None,
+    full_scan: bool = False,
+):
+  """Compute the hash values for all known hash types.
+
+  Returns (files, hash_to_rows), where files is a utils.FileTable of the images,
+  and hash_to_rows maps each hash type to {hash_value: row ids in files}. When
+  grouper is set, the (hash_value, row) pairs are added to it instead, and
+  hash_to_rows is empty.
+
+  Args:
+    src_root_dir: The directory to walk through.
+    hash_type_to_deduper: Maps hash_type to the deduper that computes it.
+    hash_store: Previously computed hashes, keyed by FileEntry.cache_key so
+      they survive moves. Files not found by their key reuse the hashes of a
+      file with the same md5, if any. Only the new or changed hashes are
+      written back to it.
+    jobs: Number of worker processes. When <= 1, hash the files serially in the
+      current process.
+    max_files_in_flight: Max number of files submitted to the workers but not
+      yet collected, defaults to 16 * jobs.
+    profiler: Measures the stages and prints the progress. Defaults to a
+      disabled one that only prints the progress.
+    use_manifest: Whether to list the files with the persistent manifest of
+      src_root_dir, see file_manifest.scan_files().
+    grouper: Groups the files on disk, for libraries too large to group in
+      memory.
+    full_scan: Whether to list all directories again, see
+      file_manifest.scan_files().
+  """
+  profiler = profiler or utils.Profiler('compute_hashes')
+  with utils.profiling(profiler):
+    return _compute_hashes(
+        src_root_dir, hash_type_to_deduper, hash_store, jobs,
+        max_files_in_flight, profiler, use_manifest, grouper, full_scan
+    )
+
+
+def _compute_hashes(
+    src_root_dir, hash_type_to_deduper, hash_store, jobs, max_files_in_flight,
+    profiler, use_manifest, grouper, full_scan
 ):
-  """Walks through the directory, computes MD5s, and generates the HTML."""
-  all_dedupers = (DeduperMd5(), DeduperSimhash())
+  # The images, each one is added once and shared by the groups of all types.
+  image_files = utils.FileTable()
+  # Maps hash_type to {hash_value: row ids in image_files}
+  hash_to_rows = collections.defaultdict(lambda: collections.defaultdict(list))
+
+  files = _iter_files(src_root_dir, use_manifest, full_scan)
+  # Dedupers to run on each file. A staged md5 deduper runs on all files at
+  # once instead, before the others.
+  per_file_dedupers = dict(hash_type_to_deduper)
+  staged_md5s = {}
+  md5_deduper = hash_type_to_deduper.get('md5')
+  if isinstance(md5_deduper, DeduperMd5) and md5_deduper.staged:
+    del per_file_dedupers['md5']
+    files = list(files)
+    profiler.total = len(files)
+    cached_md5s = {}
+    with profiler.stage('cache_get'):
+      for entry in files:
+        md5 = (
+            hash_store.get(entry.cache_key)
+            or hash_store.get(_path_file_key(entry.path, entry.size))
+        ).get('md5')
+        if md5:
+          cached_md5s[entry.path] = md5
+    with profiler.stage('staged_md5'):
+      staged_md5s = md5_deduper.staged_md5s(
+          [(entry.path, entry.size) for entry in files], cached_md5s
+      )
+
+  def add_file(fullpath, size, key, loaded, hash_values, image_size):
+    profiler.progress()
+    # Only write the new or changed hashes.
+    if hash_values != loaded:
+      with profiler.stage('cache_put'):
+        hash_store.put(key, hash_values, content_hash=hash_values.get('md5'))
+    else:
+      profiler.count('cache_hits')
+    if image_size is None:
+      profiler.count('non_images')
+      return
+
+    width, height = image_size
+    row = image_files.append(
+        os.path.relpath(fullpath, src_root_dir), size, width, height
+    )
+    for hash_type, hash_val in hash_values.items():
+      if hash_type not in hash_type_to_deduper:
+        continue  # Only cached, not asked for.
+      if grouper is not None:
+        grouper.add(hash_type, hash_val, row)
+      else:
+        hash_to_rows[hash_type][hash_val].append(row)
+
+  def iter_keyed_files():
+    """Yields (fullpath, size, key, loaded, hash_values, lookup_content)."""
+    for entry in files:
+      key = entry.cache_key
+      # Get from loaded or {}. The cache is always consulted here, so workers
+      # only compute the missing hashes.
+      with profiler.stage('cache_get'):
+        loaded, rewritten = _get_cached_hashes(hash_store, entry)
+      hash_values = _valid_cached_hashes(loaded, hash_type_to_deduper)
+      # Not cached under its key, look for a file with the same content.
+      lookup_content = not loaded
+      if rewritten:
+        profiler.count('cache_rewritten_keys')
+        # Write back, to also save the content hash.
+        loaded = {}
+      elif not loaded:
+        profiler.count('cache_misses')
+      if entry.path in staged_md5s:
+        hash_values['md5'] = staged_md5s[entry.path]
+      yield entry.path, entry.size, key, loaded, hash_values, lookup_content
+
+  if jobs <= 1:
+    for fullpath, size, key, loaded, hash_values, lookup_content in (
+        iter_keyed_files()
+    ):
+      add_file(
+          fullpath, size, key, loaded, *_hash_file(
+              fullpath, hash_values, per_file_dedupers,
+              hash_store if lookup_content else None
+          )
+      )
+    return image_files, hash_to_rows
+
+  max_files_in_flight = max_files_in_flight or 16 * jobs
+  with concurrent.futures.ProcessPoolExecutor(
+      max_workers=jobs,
+      initializer=_init_hash_worker,
+      initargs=(
+          per_file_dedupers, profiler.enabled,
+          # The workers can't see an in-memory store.
+          None if hash_store.path == ':memory:' else hash_store.path
+      ),
+  ) as executor:
+
+    def collect(fullpath, size, key, loaded, future):
+      with profiler.stage('wait_for_workers'):
+        hash_values, image_size, snapshot = future.result()
+      profiler.merge(snapshot)
+      add_file(fullpath, size, key, loaded, hash_values, image_size)
+
+    # Results are collected in submission order so the output is the same as
+    # the serial path.
+    in_flight = collections.deque()
+    for fullpath, size, key, loaded, hash_values, lookup_content in (
+        iter_keyed_files()
+    ):
+      future = executor.submit(
+          _hash_file_in_worker, fullpath, hash_values, lookup_content
+      )
+      in_flight.append((fullpath, size, key, loaded, future))
+      if len(in_flight) >= max_files_in_flight:
+        collect(*in_flight.popleft())
+    while in_flight:
+      collect(*in_flight.popleft())
+  return image_files, hash_to_rows
+
+
+def make_dedupers(
+    hash_types: Sequence[str] | None = None,
+    fast_decode: bool = False,
+    staged_md5: bool = False,
+) -> tuple[DeduperSimhash, dict[str, Deduper]]:
+  """Returns the simhash deduper and the {hash_type: deduper} to compute.
+
+  hash_types are the types to compute, all of them if None.
+  """
+  simhash_types = None
+  if hash_types is not None:
+    simhash_types = [t for t in hash_types if t != 'md5']
+  simhash_deduper = DeduperSimhash(
+      fast_decode=fast_decode, hash_types=simhash_types
+  )
+  all_dedupers = [simhash_deduper]
+  if hash_types is None or 'md5' in hash_types:
+    all_dedupers.insert(0, DeduperMd5(staged=staged_md5))
   hash_type_to_deduper = {}
   for deduper in all_dedupers:
     for hash_type in deduper.hash_types():
       assert hash_type not in hash_type_to_deduper, f'{hash_type} already exists.'
       hash_type_to_deduper[hash_type] = deduper
+  return simhash_deduper, hash_type_to_deduper
 
-  hash_json_file_path = os.path.join(src_root_dir, f'hash_all.json')
-  # Maps (file_path, file_size) to {hash_type: hash_value} dict.
-  file_key_to_hash_loaded = utils.load_json_or(
-      hash_json_file_path, collections.defaultdict(dict)
-  )
 
-  # Computes the hashes.
-  file_key_to_hash_new, hash_to_metas = compute_hashes(
-      src_root_dir, hash_type_to_deduper, file_key_to_hash_loaded
+def dedup_files(
+    src_root_dir: str,
+    dst_root_dir: str | None,
+    hash_type_to_move: str | None = None,
+    jobs: int = 1,
+    max_hamming_distance: int = 0,
+    prune_hash_store: bool = True,
+    fast_decode: bool = False,
+    staged_md5: bool = False,
+    hash_types: Sequence[str] | None = None,
+    thumbnail_dir: str | None = utils.DEFAULT_THUMBNAIL_DIR,
+    report_format: str = 'html',
+    profile_path: str | None = None,
+    use_manifest: bool = True,
+    spill_dir: str | None = None,
+    full_scan: bool = False,
+):
+  """Walks through the directory, computes MD5s, and generates the HTML.
+
+  The files are listed with <src_root_dir>/file_manifest.sqlite, which only
+  rescans the changed directories, unless use_manifest is False, see
+  file_manifest.FileManifest. With full_scan, all directories are rescanned,
+  e.g. to update the manifest after files were modified in place. The files are
+  re-statted anyway before reusing their cached hashes. The hashes are cached in
+  <src_root_dir>/hash_all.sqlite, see hash_store.HashStore. An existing
+  hash_all.json is migrated on the first run.
+  When prune_hash_store is set, the entries of files that no longer exist are
+  deleted from the cache after the walk. See DeduperSimhash for fast_decode,
+  whose simhash types end with -fast, and DeduperMd5 for staged_md5.
+
+  hash_types are the types to compute and report, e.g. ('md5',), all of them if
+  None. The cached hashes of the other types are kept. The type of
+  hash_type_to_move is always included.
+
+  The htmls show thumbnails cached in thumbnail_dir, or the original images if
+  it's None, see utils.write_html(). Each image is only read once to look up its
+  thumbnail, for all the reports. With report_format='manifest', a json
+  manifest per hash type is written instead of the htmls, to be opened by
+  browser_image_viewer/main.html, see utils.write_manifest().
+
+  When max_hamming_distance > 0, also groups the images whose simhashes differ
+  by at most that many bits, as hash type '<simhash_type>~<distance>'. These
+  groups get their own html and can be used as hash_type_to_move. A group chains
+  the images within that many bits of another one of the group, so it can have
+  images further apart, check its html before moving them. The simhash types
+  with too few bits for the number of files are skipped, see
+  simhash_index.MultiIndexHash.supports().
+
+  When profile_path is set, the time of each stage and the counters are printed
+  at the end and saved there as json, see utils.Profiler.
+
+  When spill_dir is set, the files are grouped by hash value on disk under it,
+  for libraries whose groups don't fit in memory, see
+  external_groups.ExternalGrouper. The groups are then reported ordered by hash
+  value. The near duplicates are still grouped in memory, one simhash type at a
+  time.
+  """
+  profiler = utils.Profiler('dedup', enabled=bool(profile_path))
+  if hash_types is not None and hash_type_to_move is not None:
+    # Strip the max Hamming distance of near duplicate types.
+    hash_types = {*hash_types, hash_type_to_move.split('~')[0]}
+  simhash_deduper, hash_type_to_deduper = make_dedupers(
+      hash_types, fast_decode=fast_decode, staged_md5=staged_md5
   )
 
-  # Save the hash to avoid recomputation next time.
-  utils.dump_json(hash_json_file_path, file_key_to_hash_new)
+  # Its spilled runs are also removed if this fails, when it's garbage
+  # collected.
+  grouper = None
+  if spill_dir:
+    grouper = external_groups.ExternalGrouper(spill_dir)
+
+  # Maps FileEntry.cache_key to {hash_type: hash_value} dict.
+  with hash_store_lib.open_hash_store(src_root_dir) as hash_store:
+    hash_store.track_seen_keys = prune_hash_store
+    # Computes the hashes, and save them to avoid recomputation next time.
+    image_files, hash_to_rows = compute_hashes(
+        src_root_dir,
+        hash_type_to_deduper,
+        hash_store,
+        jobs=jobs,
+        profiler=profiler,
+        use_manifest=use_manifest,
+        grouper=grouper,
+        full_scan=full_scan,
+    )
+    if prune_hash_store:
+      with profiler.stage('cache_prune'):
+        num_pruned = hash_store.prune_unseen()
+      print(f'\033[93m=> Pruned {num_pruned} stale hash entries.\033[0m')
+
+  def groups_of(hash_type):
+    """The {hash_value: rows} or the (hash_value, rows) of the hash type."""
+    if grouper is None or hash_type in hash_to_rows:
+      return hash_to_rows[hash_type]
+    return grouper.iter_groups(hash_type)
+
+  # Group the near duplicates.
+  hash_type_to_report = dict(hash_type_to_deduper)
+  if max_hamming_distance > 0:
+    for cfg in simhash_deduper.cfgs:
+      simhash_type = simhash_deduper.hash_type(cfg)
+      # The number of files bounds the number of distinct hashes.
+      if not simhash_index.MultiIndexHash.supports(
+          cfg.num_bits, max_hamming_distance, len(image_files)
+      ):
+        print(
+            f'\033[93m=> Skipping near duplicates of {simhash_type}, too few '
+            f'bits for {len(image_files)} files.\033[0m'
+        )
+        continue
+      near_hash_type = f'{simhash_type}~{max_hamming_distance}'
+      with profiler.stage('near_dups'):
+        if grouper is None:
+          simhash_to_rows = hash_to_rows[simhash_type]
+        else:
+          # All hashes are needed, including the ones of single files.
+          simhash_to_rows = dict(grouper.iter_groups(simhash_type, 1))
+        near_groups = simhash_index.group_near_duplicates(
+            simhash_to_rows, cfg.num_bits, max_hamming_distance
+        )
+        del simhash_to_rows
+        if grouper is not None:
+          # Only keep the groups to show.
+          near_groups = {
+              key: rows for key, rows in near_groups.items() if len(rows) > 1
+          }
+        hash_to_rows[near_hash_type] = near_groups
+      hash_type_to_report[near_hash_type] = simhash_deduper
 
   # Move the duplicates with largest filename to dst_root_dir.
   if hash_type_to_move is not None:
-    updated_hash_to_metas = maybe_move(
-        hash_to_metas[hash_type_to_move],
-        hash_type_to_deduper[hash_type_to_move], src_root_dir, dst_root_dir
-    )
-    hash_to_metas[hash_type_to_move] = updated_hash_to_metas
+    with profiler.stage('move'):
+      if grouper is not None:
+        # Only the groups of duplicates, the other files are not moved.
+        hash_to_rows[hash_type_to_move] = dict(groups_of(hash_type_to_move))
+      maybe_move(
+          hash_to_rows[hash_type_to_move], image_files,
+          hash_type_to_report[hash_type_to_move], src_root_dir, dst_root_dir
+      )
 
   # Generate the htmls for comparison.
-  for hash_type, deduper in hash_type_to_deduper.items():
-    html = utils.generate_html(
-        hash_to_metas[hash_type], scale_image_by_width=True
-    )
-    html_file_path = os.path.join(
-        src_root_dir, f'image_mapping_{hash_type}.html'
-    )
-    with open(html_file_path, 'w') as f:
-      f.write(html)
+  assert report_format in ('html', 'manifest'), f'{report_format=}'
+  # The same images are in the reports of most hash types, only look up their
+  # thumbnails once.
+  thumbnail_cache = {}
+  for hash_type, deduper in hash_type_to_report.items():
+    with profiler.stage('report'):
+      if report_format == 'manifest':
+        utils.write_manifest(
+            os.path.join(
+                src_root_dir, f'image_mapping_{hash_type}.manifest.json'
+            ),
+            groups_of(hash_type),
+            scale_image_by_width=True,
+            thumbnail_dir=thumbnail_dir,
+            file_table=image_files,
+            thumbnail_cache=thumbnail_cache,
+        )
+        continue
+      html_file_path = os.path.join(
+          src_root_dir, f'image_mapping_{hash_type}.html'
+      )
+      utils.write_html(
+          html_file_path,
+          groups_of(hash_type),
+          scale_image_by_width=True,
+          thumbnail_dir=thumbnail_dir,
+          file_table=image_files,
+          thumbnail_cache=thumbnail_cache,
+      )
+  if grouper is not None:
+    grouper.close()
+
+  profiler.print_summary()
+  if profile_path:
+    profiler.dump(profile_path)
 
 
 if __name__ == '__main__':
@@ -269,8 +945,34 @@ if __name__ == '__main__':
 
   hash_type_to_move = None
 
+  # Number of processes to compute the hashes.
+  jobs = os.cpu_count()
+
+  # Also report images whose simhashes differ by at most this many bits.
+  max_hamming_distance = 0
+
+  # Hash types to compute and report, e.g. ('md5',). None for all types.
+  hash_types = None
+
+  # Where to save the time of each stage, None to not profile.
+  profile_path = None
+
+  # Where to group the files on disk, for libraries too large to group in
+  # memory. None to group in memory.
+  spill_dir = None
+
+  # Whether to list all directories again, to pick up the files modified in
+  # place, which the manifest misses.
+  full_scan = False
+
   dedup_files(
       src_root_dir=src_root_dir,
       dst_root_dir=dst_root_dir,
-      hash_type_to_move=hash_type_to_move
+      hash_type_to_move=hash_type_to_move,
+      jobs=jobs,
+      max_hamming_distance=max_hamming_distance,
+      hash_types=hash_types,
+      profile_path=profile_path,
+      spill_dir=spill_dir,
+      full_scan=full_scan,
   )
@@ -1,18 +1,22 @@
 import abc
 import base64
 import collections
+import concurrent.futures
 from collections import OrderedDict
 import hashlib
 import dataclasses
+import itertools
 import json
 import os
 import typing
-from typing import Any, Protocol
+from typing import Any, Callable, Iterable, Protocol
 
 import cv2
 import numpy as np
 from PIL import Image
 
+import file_manifest
+import prediction_store
 import utils
 
 _DEBUG = False
@@ -31,21 +35,24 @@ def gen_html(
     src_root_dir: str,
     dir_suffix: str,
     html_name: str,
-    meta_dict: dict[str, list[utils.ImageFileMeta]],
+    rows: Iterable[tuple[str, list[utils.ImageFileMeta]]],
+    thumbnail_dir: str | None = None,
 ):
   html_dir = os.path.join(src_root_dir, f'score_html-{dir_suffix}')
   if not os.path.exists(html_dir):
     os.makedirs(html_dir)
 
-  html = utils.generate_html(
-      grouped_images=meta_dict,
+  html_file_path = os.path.join(html_dir, f'{html_name}.html')
+  # Each html page contains at most 100 rows.
+  utils.write_html(
+      html_file_path,
+      rows,
       cell_width=200,
       check_first_image_path=False,
       num_images_in_group_to_show_thres=1,
+      groups_per_page=100,
+      thumbnail_dir=thumbnail_dir,
   )
-  html_file_path = os.path.join(html_dir, f'{html_name}.html')
-  with open(html_file_path, 'w') as f:
-    f.write(html)
 
 
 @utils.make_dataclass()
@@ -53,15 +60,21 @@ class _FileInfo:
   fullpath: str
   size: int
   key: str  # Key of the prediction cache.
+  content_hash: str | None = None  # MD5 of the file, when known.
+  w: int = 1
+  h: int = 1
+  # prediction_store.DETECTION_DTYPE array of the predictor's detections.
   metrics: Any = None
   score: float = 0  # Nsfw score, used for grouping.
   meta_key: str = ''  # Key of the html group, used for grouping
 
-  def to_meta(self):
+  def to_meta(self, class_names: tuple[str, ...]):
     return utils.ImageFileMeta(
         relative_path=self.fullpath,
         size=self.size,
-        meta=(self.metrics, self.score),
+        w=self.w,
+        h=self.h,
+        meta=(prediction_store.to_dicts(self.metrics, class_names), self.score),
     )
 
   def __lt__(self, rhs):
@@ -69,47 +82,61 @@ class _FileInfo:
     return key(self) < key(rhs)
 
 
+def _iter_rows(
+    infos: list[_FileInfo], imgs_per_row: int, class_names: tuple[str, ...]
+):
+  """Yields (row_key, list[ImageFileMeta]) of at most imgs_per_row images."""
+  for i in range(0, len(infos), imgs_per_row):
+    row = infos[i:i + imgs_per_row]
+    yield f'{row[0].meta_key}-{row[0].score}', [
+        info.to_meta(class_names) for info in row
+    ]
+
+
 def write_htmls(
-    all_infos: list[_FileInfo], imgs_per_row: int, predictor_name: str
+    all_infos: list[_FileInfo],
+    imgs_per_row: int,
+    predictor_name: str,
+    src_root_dir: str,
+    thumbnail_dir: str | None = None,
+    report_format: str = 'html',
+    class_names: tuple[str, ...] = (),
 ):
   if _DEBUG:
     for info in all_infos:
       print(f'\033[93m=> {info}\033[0m')
   all_infos.sort()
 
-  html_index = 0
-  cur_row = None
-  cur_meta_key = None
-  num_row_elems = imgs_per_row + 1
-  meta_dict = collections.defaultdict(list)
-  for info in all_infos:
-    if num_row_elems >= imgs_per_row or info.meta_key != cur_meta_key:
-      if len(meta_dict) >= 100 or (meta_dict and info.meta_key != cur_meta_key):
-        # Each html contains at most 100 rows.
-        gen_html(
-            src_root_dir,
-            dir_suffix=predictor_name,
-            html_name=f'{cur_meta_key}-{html_index:03}',
-            meta_dict=meta_dict,
+  if report_format == 'manifest':
+    # A single manifest of all rows, for browser_image_viewer/main.html.
+    html_dir = os.path.join(src_root_dir, f'score_html-{predictor_name}')
+    if not os.path.exists(html_dir):
+      os.makedirs(html_dir)
+    rows = itertools.chain.from_iterable(
+        _iter_rows(list(infos), imgs_per_row, class_names)
+        for _, infos in itertools.groupby(
+            all_infos, key=lambda info: info.meta_key
         )
-        meta_dict.clear()
-        html_index += 1
-
-      # Starts a new row.
-      row_key = f'{info.meta_key}-{info.score}'
-      cur_row = meta_dict[row_key]
-      cur_meta_key = info.meta_key
-      num_row_elems = 0
-
-    cur_row.append(info.to_meta())
-    num_row_elems += 1
+    )
+    utils.write_manifest(
+        os.path.join(html_dir, 'manifest.json'),
+        rows,
+        cell_width=200,
+        num_images_in_group_to_show_thres=1,
+        thumbnail_dir=thumbnail_dir,
+    )
+    return
 
-  if meta_dict:
+  # Each meta_key gets its own html, the rows are streamed to its pages.
+  for meta_key, infos in itertools.groupby(
+      all_infos, key=lambda info: info.meta_key
+  ):
     gen_html(
         src_root_dir,
         dir_suffix=predictor_name,
-        html_name=f'{cur_meta_key}-{html_index:03}',
-        meta_dict=meta_dict,
+        html_name=meta_key,
+        rows=_iter_rows(list(infos), imgs_per_row, class_names),
+        thumbnail_dir=thumbnail_dir,
     )
 
 
@@ -120,9 +147,15 @@ class Predictor(Protocol):
   def name(self) -> str:
     """Name of the predictor. Used for json and html file names."""
 
+  @property
+  @abc.abstractmethod
+  def class_names(self) -> tuple[str, ...]:
+    """Classes of the detections, saved as their indices in the cache."""
+
   @abc.abstractmethod
   def run(self, imgs: list[str]) -> dict[str, Any]:
-    """Run prediction and return the prediction result to save to json."""
+    """Run prediction and return the [{'class', 'score', 'box'}] of each image.
+    """
 
   @abc.abstractmethod
   def score_and_update(self, info: _FileInfo) -> None:
@@ -156,12 +189,25 @@ _CLASS_WEIGHT_NUDENET = (
     ('FACE_MALE', 1, '09-face_male'),
     ('MALE_BREAST_EXPOSED', 1, '09-breast_male'),
 )
+_CLASS_NAMES_NUDENET = tuple(name for name, _, _ in _CLASS_WEIGHT_NUDENET)
 
 
-def _create_nude_predictor():
+def _create_nude_predictor(num_threads: int | None = None):
+  """Creates the detector, using num_threads onnxruntime threads if set."""
   print(f'\033[93m=> Remember to: pip install nudenet \033[0m')
   from nudenet import NudeDetector
-  return NudeDetector()
+  detector = NudeDetector()
+  if num_threads:
+    # NudeDetector doesn't take session options, so recreate its session.
+    import onnxruntime
+    options = onnxruntime.SessionOptions()
+    options.intra_op_num_threads = num_threads
+    options.inter_op_num_threads = 1
+    session = detector.onnx_session
+    detector.onnx_session = onnxruntime.InferenceSession(
+        session._model_path, options, providers=session.get_providers()
+    )
+  return detector
 
 
 @utils.make_dataclass(frozen=True)
@@ -172,8 +218,16 @@ class NudePredictor(Predictor):
   src_root_dir: str = None
   dst_root_dir: str = None
 
+  # The images are read and decoded by decode_threads threads, up to
+  # prefetch_batches batches of detect_batch_size images ahead of the detector,
+  # see utils.pipelined_batches().
+  decode_threads: int = 4
+  prefetch_batches: int = 2
+  detect_batch_size: int = 16
+
   _detector: Any = dataclasses.field(default_factory=_create_nude_predictor)
-  _class_weight_map = {k: w for k, w, _ in _CLASS_WEIGHT_NUDENET}
+  # Weight of each class, indexed by the class id.
+  _class_weights = tuple(w for _, w, _ in _CLASS_WEIGHT_NUDENET)
 
   def __post_init__(self):
     assert bool(self.src_root_dir) == bool(
@@ -184,24 +238,64 @@ class NudePredictor(Predictor):
   def name(self) -> str:
     return 'nudenet'
 
+  @property
+  def class_names(self) -> tuple[str, ...]:
+    return _CLASS_NAMES_NUDENET
+
   def run(self, imgs):
-    res = self._detector.detect_batch(imgs)
+    # The detector takes decoded images as well as paths.
+    res = utils.pipelined_batches(
+        imgs,
+        self._decode_image,
+        self._detector.detect_batch,
+        batch_size=self.detect_batch_size,
+        num_threads=self.decode_threads,
+        prefetch_batches=self.prefetch_batches,
+    )
     return {k: v for k, v in zip(imgs, res)}
 
+  def _decode_image(self, fullpath: str):
+    """Decodes the image as BGR like cv2.imread(), or returns the path on error.
+
+    Returning the path leaves the error handling to the detector, like before.
+    """
+    try:
+      with open(fullpath, 'rb') as f:
+        file_bytes = f.read()
+      image = cv2.imdecode(
+          np.frombuffer(file_bytes, np.uint8), cv2.IMREAD_COLOR
+      )
+    except OSError:
+      return fullpath
+    return fullpath if image is None else image
+
   def score_and_update(self, info: _FileInfo):
     image = None
     if self.dst_root_dir:
-      image = cv2.imread(info.fullpath)
+      profiler = utils.current_profiler()
+      # Read the file once, for both the size and the decoded image.
+      with profiler.stage('read'), open(info.fullpath, 'rb') as f:
+        file_bytes = f.read()
+      with profiler.stage('probe_size'):
+        image_size = utils.probe_image_size(info.fullpath, file_bytes)
+      info.w, info.h = image_size or (1, 1)
+      with profiler.stage('decode'):
+        image = cv2.imdecode(
+            np.frombuffer(file_bytes, np.uint8), cv2.IMREAD_COLOR
+        )
 
+    detections = info.metrics
+    if image is not None:
+      # If in debug mode, draw the bounding boxes.
+      for metric in prediction_store.to_dicts(detections, self.class_names):
+        self._draw_box(
+            image, metric['box'], f'{metric["class"]}: {metric["score"]}'
+        )
+    # A file has a few detections, a python loop beats numpy calls on them.
     score = 0
     classes = 0
-    for metric in info.metrics:
-      cls = metric['class']
-      sc = metric['score']
-      if image is not None:
-        # If in debug mode, draw the bounding boxes.
-        self._draw_box(image, metric['box'], f'{cls}: {sc}')
-      weight = self._class_weight_map[cls]
+    for class_id, sc, _ in detections.tolist():
+      weight = self._class_weights[class_id]
       score += (1 + sc) * weight
       classes |= weight
     info.score = score
@@ -256,75 +350,384 @@ class NudePredictor(Predictor):
     )
 
 
+def create_worker_nude_predictor(num_threads: int) -> NudePredictor:
+  """Creates a NudePredictor in a ParallelPredictor worker."""
+  return NudePredictor(
+      decode_threads=2, _detector=_create_nude_predictor(num_threads)
+  )
+
+
+# The predictor of the ParallelPredictor worker process, see
+# _init_predict_worker().
+_worker_predictor = None
+
+
+def _init_predict_worker(
+    create_predictor: Callable[[int], Predictor], threads_per_worker: int
+):
+  global _worker_predictor
+  # Set before the predictor is created, for libraries reading them at init.
+  for var in ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS'):
+    os.environ[var] = str(threads_per_worker)
+  cv2.setNumThreads(threads_per_worker)
+  _worker_predictor = create_predictor(threads_per_worker)
+
+
+def _predict_in_worker(imgs: list[str]) -> list[Any]:
+  res = _worker_predictor.run(imgs)
+  return [res[img] for img in imgs]
+
+
+class ParallelPredictor(Predictor):
+  """Runs a predictor in a pool of worker processes.
+
+  Each worker creates its own predictor once with
+  create_predictor(threads_per_worker), which should limit its intra-op threads
+  to that, so num_workers * threads_per_worker is about the number of cores.
+  The images of run() are split into chunks of chunk_size and predicted by the
+  workers in parallel, so give it at least num_workers * chunk_size images at a
+  time, e.g. with the batch_size of run().
+
+  create_predictor must be picklable, e.g. a module level function like
+  create_worker_nude_predictor. name and score_and_update() are delegated to
+  scorer in this process, which doesn't need a model, e.g.
+  NudePredictor(_detector=None).
+
+  The worker processes are started on first use, call close() or use it as a
+  context manager to stop them.
+  """
+
+  def __init__(
+      self,
+      scorer: Predictor,
+      create_predictor: Callable[[int], Predictor],
+      num_workers: int = 2,
+      threads_per_worker: int | None = None,
+      chunk_size: int = 16,
+  ):
+    self._scorer = scorer
+    self._create_predictor = create_predictor
+    self._num_workers = num_workers
+    self._threads_per_worker = threads_per_worker or max(
+        1, (os.cpu_count() or 1) // num_workers
+    )
+    self._chunk_size = chunk_size
+    self._executor = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def close(self):
+    if self._executor:
+      self._executor.shutdown()
+      self._executor = None
+
+  @property
+  def name(self) -> str:
+    return self._scorer.name
+
+  @property
+  def class_names(self) -> tuple[str, ...]:
+    return self._scorer.class_names
+
+  def run(self, imgs):
+    if self._executor is None:
+      self._executor = concurrent.futures.ProcessPoolExecutor(
+          self._num_workers,
+          initializer=_init_predict_worker,
+          initargs=(self._create_predictor, self._threads_per_worker),
+      )
+    chunks = [
+        imgs[i:i + self._chunk_size]
+        for i in range(0, len(imgs), self._chunk_size)
+    ]
+    # map() returns the results in the order of the chunks.
+    res = itertools.chain.from_iterable(
+        self._executor.map(_predict_in_worker, chunks)
+    )
+    return {k: v for k, v in zip(imgs, res)}
+
+  def score_and_update(self, info: _FileInfo):
+    self._scorer.score_and_update(info)
+
+
 def run(
     predictor: Predictor,
     *,
     src_root_dir: str,
     first_n: int = 999999999,
-    imgs_per_row: int = 10
+    imgs_per_row: int = 10,
+    thumbnail_dir: str | None = utils.DEFAULT_THUMBNAIL_DIR,
+    report_format: str = 'html',
+    profile_path: str | None = None,
+    use_manifest: bool = True,
+    batch_size: int = 64,
+    checkpoint_every: int = 10,
+    full_scan: bool = False,
 ):
-  predict_result_json_file_path = os.path.join(
-      src_root_dir, f'prediction_result-{predictor.name}.json'
-  )
-  # Maps (file_path, file_size) to {metric_name: metric_value}.
-  predict_result_loaded = utils.load_json_or(
-      predict_result_json_file_path, collections.defaultdict(dict)
-  )
-  predict_result_new = collections.defaultdict(dict)
+  """Predicts the images under src_root_dir, and writes the reports.
+
+  report_format is either 'html' for a set of html pages per meta_key, or
+  'manifest' for a single json manifest for browser_image_viewer/main.html.
+  When profile_path is set, the time of each stage is printed at the end and
+  saved there as json, see utils.Profiler.
+  The files are listed with the persistent manifest of src_root_dir unless
+  use_manifest is False, see file_manifest.scan_files() for it and full_scan.
+
+  The predictions are cached in prediction_result-<name>.store, see
+  prediction_store.PredictionStore. An existing prediction_result-<name>.json is
+  migrated on the first run. The images are predicted batch_size at a time, and
+  the results are flushed to the store every checkpoint_every batches. If the
+  run is interrupted, the next run resumes from there.
+
+  The predictions are cached by file_manifest.FileEntry.cache_key, so moved
+  files keep theirs, and the files are re-statted so the ones modified in place
+  are predicted again. Files not found by their key reuse the prediction of a
+  file with the same md5.
+  """
+  profiler = utils.Profiler('sfw', enabled=bool(profile_path))
+  with utils.profiling(profiler):
+    _run(
+        predictor, src_root_dir, first_n, imgs_per_row, thumbnail_dir,
+        report_format, profiler, use_manifest, batch_size, checkpoint_every,
+        full_scan
+    )
+  profiler.print_summary()
+  if profile_path:
+    profiler.dump(profile_path)
+
+
+def _find_cached_prediction(
+    info: _FileInfo, store: prediction_store.PredictionStore
+) -> tuple[str | None, str]:
+  """Returns the key of the cached metrics of the file or None, and how.
+
+  The metrics are looked up by info.key ('cache_hits'), then by the key of the
+  file before file_manifest.FileEntry.cache_key ('cache_rewritten_keys'), and
+  then by the md5 of the file ('content_hits'), or not found ('cache_misses').
+  The md5 is saved to info.content_hash, also for the files found by the old key
+  so their copies can be found next time.
+  """
+  if info.key in store:
+    return info.key, 'cache_hits'
+
+  try:
+    with utils.current_profiler().stage('content_hash'):
+      info.content_hash = utils.md5_of_file(info.fullpath)
+  except OSError as e:
+    print(f'\033[91m=> Failed to compute md5 of {info.fullpath}: {e}\033[0m')
+    return None, 'cache_misses'
+  path_key = f'{info.fullpath.encode("utf-8")}:{info.size}'
+  if path_key in store:
+    return path_key, 'cache_rewritten_keys'
+  key = store.find_by_content(info.content_hash)
+  if key is not None:
+    return key, 'content_hits'
+  return None, 'cache_misses'
+
+
+def _dedup_by_content(
+    infos: list[_FileInfo]
+) -> tuple[list[_FileInfo], list[tuple[_FileInfo, _FileInfo]]]:
+  """Finds the byte-identical files by their content_hash.
+
+  Returns the infos to predict, with one file per content, and the
+  (info, source_info) of the other files, which reuse the prediction of
+  source_info.
+  """
+  unique_infos = []
+  copies = []
+  content_to_info = {}
+  for info in infos:
+    source = content_to_info.get(info.content_hash)
+    if source is not None:
+      copies.append((info, source))
+      continue
+    if info.content_hash:
+      content_to_info[info.content_hash] = info
+    unique_infos.append(info)
+  utils.current_profiler().count('content_dups', len(copies))
+  return unique_infos, copies
+
+
+def _predict_in_batches(
+    predictor: Predictor,
+    infos: list[_FileInfo],
+    store: prediction_store.PredictionStore,
+    batch_size: int,
+    checkpoint_every: int,
+):
+  """Predicts the infos, and adds the results to the store by key.
+
+  The store is flushed every checkpoint_every batches.
+  """
+  profiler = utils.current_profiler()
+  for i in range(0, len(infos), batch_size):
+    batch = infos[i:i + batch_size]
+    with profiler.stage('predict'):
+      prediction_result = predictor.run([info.fullpath for info in batch])
+    profiler.count('predicted', len(batch))
+    for info in batch:
+      store.append(
+          info.key, prediction_result[info.fullpath], info.content_hash
+      )
+    if (i // batch_size + 1) % checkpoint_every == 0:
+      with profiler.stage('checkpoint'):
+        store.flush()
+      print(
+          f'\033[93m=> Predicted {i + len(batch)}/{len(infos)} images.\033[0m'
+      )
+
+
+def _run(
+    predictor, src_root_dir, first_n, imgs_per_row, thumbnail_dir,
+    report_format, profiler, use_manifest, batch_size, checkpoint_every,
+    full_scan
+):
+  with profiler.stage('cache_load'):
+    store = prediction_store.open_prediction_store(
+        src_root_dir, predictor.name, predictor.class_names
+    )
+  with store:
+    _run_with_store(
+        predictor, store, src_root_dir, first_n, imgs_per_row, thumbnail_dir,
+        report_format, profiler, use_manifest, batch_size, checkpoint_every,
+        full_scan
+    )
 
+
+def _run_with_store(
+    predictor, store, src_root_dir, first_n, imgs_per_row, thumbnail_dir,
+    report_format, profiler, use_manifest, batch_size, checkpoint_every,
+    full_scan
+):
   print(f'\033[93m=> Getting all image file paths...\033[0m')
   all_infos = []
   infos_to_predict = []
+  # (info, key) of the files whose prediction is cached under another key.
+  infos_to_rekey = []
   num_files = 0
-
-  for cur_path, _, files in os.walk(src_root_dir):
+  # Number of files by how their predictions are found, see
+  # _find_cached_prediction().
+  reuse_stats = collections.Counter()
+
+  entries = file_manifest.scan_files(src_root_dir, use_manifest, full_scan)
+  profiler.total = min(len(entries), first_n)
+  for entry in entries:
+    if should_skip(entry.path):
+      profiler.count('skipped_files')
+      continue
+    # Don't reuse the prediction of a file modified in place.
+    with profiler.stage('restat'):
+      current_entry = entry.restat()
+    if current_entry is None:
+      continue
+    if current_entry is not entry:
+      profiler.count('modified_in_place')
+      entry = current_entry
+
+    info = _FileInfo(fullpath=entry.path, size=entry.size, key=entry.cache_key)
+    all_infos.append(info)
+
+    key, found_by = _find_cached_prediction(info, store)
+    profiler.count(found_by)
+    reuse_stats[found_by] += 1
+    if key is None:
+      infos_to_predict.append(info)
+    elif key != info.key:
+      infos_to_rekey.append((info, key))
+
+    num_files += 1
+    profiler.progress()
     if num_files > first_n:
       break
-    for filename in files:
-      if should_skip(filename):
-        continue
-
-      fullpath = os.path.join(cur_path, filename)
-      size = os.path.getsize(fullpath)
-      key = f'{fullpath.encode("utf-8")}:{size}'
-      info = _FileInfo(fullpath=fullpath, size=size, key=key)
-      all_infos.append(info)
-
-      if key in predict_result_loaded:
-        predict_result_new[key] = predict_result_loaded[key]
-      else:
-        infos_to_predict.append(info)
-
-      num_files += 1
-      if num_files > first_n:
-        break
 
   print(f'\033[93m=> Running predictions...\033[0m')
-  file_paths_to_predict = [info.fullpath for info in infos_to_predict]
+  unique_infos, copies = _dedup_by_content(infos_to_predict)
   if _DEBUG:
-    print(f'\033[93m=> {file_paths_to_predict}\033[0m')
-  if file_paths_to_predict:
-    prediction_result = predictor.run(file_paths_to_predict)
-    for info in infos_to_predict:
-      predict_result_new[info.key] = prediction_result[info.fullpath]
-  utils.dump_json(predict_result_json_file_path, predict_result_new)
+    print(f'\033[93m=> {[info.fullpath for info in unique_infos]}\033[0m')
+  if unique_infos:
+    _predict_in_batches(
+        predictor, unique_infos, store, batch_size, checkpoint_every
+    )
+  print(
+      f'\033[93m=> Predicted {len(unique_infos)} of {len(all_infos)} images. '
+      f'Reused the predictions of '
+      f'{reuse_stats["cache_hits"] + reuse_stats["cache_rewritten_keys"]} '
+      f'cached images, {reuse_stats["content_hits"]} copies of cached images '
+      f'and {len(copies)} copies of images predicted in this run.\033[0m'
+  )
 
-  for info in all_infos:
-    info.metrics = predict_result_new[info.key]
-    predictor.score_and_update(info)
+  with profiler.stage('cache_dump'):
+    # Save the reused predictions under the keys of the files, for next time.
+    infos_to_rekey.extend((info, source.key) for info, source in copies)
+    for info, key in infos_to_rekey:
+      store.append(info.key, store.get(key), info.content_hash)
+    # Drop the files no longer there when they are the majority.
+    if store.num_records > 2 * len(all_infos):
+      store.compact(info.key for info in all_infos)
+    else:
+      store.flush()
+
+  with profiler.stage('score'):
+    for info in all_infos:
+      info.metrics = store.get(info.key)
+      predictor.score_and_update(info)
 
   print(f'\033[93m=> Generating htmls...\033[0m')
-  write_htmls(all_infos, imgs_per_row, predictor.name)
+  with profiler.stage('report'):
+    write_htmls(
+        all_infos, imgs_per_row, predictor.name, src_root_dir, thumbnail_dir,
+        report_format, predictor.class_names
+    )
 
 
 if __name__ == '__main__':
   src_root_dir = '/Users/laigd/Documents/images/eee/网页'
   src_root_dir = '/tmp/nsfw-test'
-  predictor = NudePredictor(
-      src_root_dir=src_root_dir, dst_root_dir='/tmp/nsfw-moved'
-  )
+  dst_root_dir = '/tmp/nsfw-moved'
+
+  # Number of worker processes to predict in, 0 to predict in this process.
+  num_workers = 0
+  if num_workers:
+    predictor = ParallelPredictor(
+        scorer=NudePredictor(
+            src_root_dir=src_root_dir,
+            dst_root_dir=dst_root_dir,
+            _detector=None,
+        ),
+        create_predictor=create_worker_nude_predictor,
+        num_workers=num_workers,
+    )
+  else:
+    predictor = NudePredictor(
+        src_root_dir=src_root_dir, dst_root_dir=dst_root_dir
+    )
 
   first_n = 999999999
   first_n = 100000
 
-  run(predictor, src_root_dir=src_root_dir, first_n=first_n, imgs_per_row=7)
+  # Where to save the time of each stage, None to not profile.
+  profile_path = None
+
+  # Whether to list all directories again, to pick up the files modified in
+  # place, which the manifest misses.
+  full_scan = False
+
+  try:
+    run(
+        predictor,
+        src_root_dir=src_root_dir,
+        first_n=first_n,
+        imgs_per_row=7,
+        profile_path=profile_path,
+        # Enough images to keep all workers busy.
+        batch_size=max(64, num_workers * 16 * 2),
+        full_scan=full_scan,
+    )
+  finally:
+    if num_workers:
+      predictor.close()
@@ -0,0 +1,120 @@
+import collections
+import heapq
+import itertools
+import os
+import struct
+import tempfile
+from typing import Any, Iterator
+
+import utils
+
+# Header of a (hash value, row) record in a run: the row, the type of the hash
+# value and the length of its bytes, which follow.
+_RECORD_HEADER = struct.Struct('<IBH')
+_INT = 0
+_STR = 1
+
+
+def _encode(hash_val: int | str) -> tuple[int, bytes]:
+  if isinstance(hash_val, int):
+    return _INT, hash_val.to_bytes((hash_val.bit_length() + 7) // 8, 'big')
+  return _STR, hash_val.encode('utf-8')
+
+
+def _write_run(path: str, pairs: list[tuple[Any, int]]):
+  with open(path, 'wb') as f:
+    for hash_val, row in pairs:
+      value_type, data = _encode(hash_val)
+      f.write(_RECORD_HEADER.pack(row, value_type, len(data)))
+      f.write(data)
+
+
+def _read_run(path: str) -> Iterator[tuple[Any, int]]:
+  with open(path, 'rb', buffering=2**16) as f:
+    while header := f.read(_RECORD_HEADER.size):
+      row, value_type, length = _RECORD_HEADER.unpack(header)
+      data = f.read(length)
+      if value_type == _INT:
+        yield int.from_bytes(data, 'big'), row
+      else:
+        yield data.decode('utf-8'), row
+
+
+class ExternalGrouper:
+  """Groups the rows of the files by hash value, with the pairs kept on disk.
+
+  The in memory {hash_value: rows} dict of each hash type doesn't fit in memory
+  for tens of millions of files. Instead, add() buffers the (hash_value, row)
+  pairs, and once max_pairs_in_memory are buffered, each hash type's buffer is
+  sorted and written to a run file in a temp dir under spill_dir. iter_groups()
+  merges the runs of a hash type with heapq.merge, so only a record per run
+  and the current group are in memory.
+
+  Unlike the dict, the groups come out ordered by hash value, not by their
+  first file. The rows of a group are in the order they were added.
+  """
+
+  def __init__(
+      self, spill_dir: str | None = None, max_pairs_in_memory: int = 2000000
+  ):
+    """Spills to a temp dir under spill_dir, or the system's if None."""
+    if spill_dir:
+      os.makedirs(spill_dir, exist_ok=True)
+    # Removed by close(), or when garbage collected.
+    self._tmp_dir = tempfile.TemporaryDirectory(
+        prefix='dedup_groups_', dir=spill_dir
+    )
+    self.max_pairs_in_memory = max_pairs_in_memory
+    self._buffers = collections.defaultdict(list)
+    self._num_buffered = 0
+    # Maps hash_type to the paths of its sorted runs.
+    self._run_paths = collections.defaultdict(list)
+    self._num_spills = 0
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def close(self):
+    self._buffers.clear()
+    self._tmp_dir.cleanup()
+
+  def add(self, hash_type: str, hash_val: int | str, row: int):
+    self._buffers[hash_type].append((hash_val, row))
+    self._num_buffered += 1
+    if self._num_buffered >= self.max_pairs_in_memory:
+      self._spill()
+
+  def _spill(self):
+    profiler = utils.current_profiler()
+    with profiler.stage('group_spill'):
+      for type_index, (hash_type, pairs) in enumerate(self._buffers.items()):
+        pairs.sort()
+        path = os.path.join(
+            self._tmp_dir.name, f'{self._num_spills:05}-{type_index}.run'
+        )
+        _write_run(path, pairs)
+        self._run_paths[hash_type].append(path)
+        profiler.count('group_runs')
+    self._buffers.clear()
+    self._num_buffered = 0
+    self._num_spills += 1
+
+  def iter_groups(
+      self, hash_type: str, num_images_in_group_to_show_thres: int = 2
+  ) -> Iterator[tuple[Any, list[int]]]:
+    """Yields the (hash_value, rows) of the groups with enough files.
+
+    Can be called again, e.g. for another report of the same hash type.
+    """
+    pairs = self._buffers.get(hash_type, [])
+    pairs.sort()  # The pairs not spilled yet are merged as one more run.
+    merged = heapq.merge(
+        *(_read_run(path) for path in self._run_paths[hash_type]), pairs
+    )
+    for hash_val, group in itertools.groupby(merged, key=lambda p: p[0]):
+      rows = [row for _, row in group]
+      if len(rows) >= num_images_in_group_to_show_thres:
+        yield hash_val, rows
@@ -0,0 +1,245 @@
+import os
+import sqlite3
+import time
+from typing import Iterator
+
+import utils
+
+MANIFEST_NAME = 'file_manifest.sqlite'
+_MANIFEST_FILES = tuple(MANIFEST_NAME + s for s in ('', '-wal', '-shm'))
+
+# A directory modified this close to the scan may be modified again within the
+# mtime granularity of the file system without its mtime changing, so it's
+# always rescanned next time.
+_RACY_MTIME_NS = 2 * 10**9
+
+
+@utils.make_dataclass(frozen=True)
+class FileEntry:
+  path: str  # Full path.
+  size: int
+  mtime_ns: int
+  inode: int
+
+  @property
+  def cache_key(self) -> str:
+    """Key of the file in the hash and prediction caches.
+
+    Unlike the path, it survives renames and moves within the file system, which
+    keep the inode and the mtime. A copy, or a move across file systems, gets a
+    new key; the caches fall back to the content hash for these.
+    """
+    return f'{self.inode}:{self.size}:{self.mtime_ns}'
+
+  def restat(self) -> 'FileEntry | None':
+    """Returns the entry with the current stat of the file, None if it's gone.
+
+    A file modified in place doesn't change the mtime of its directory, so its
+    size and mtime in the manifest can be stale, see FileManifest. Re-stat it
+    before using its cache_key to reuse cached results.
+    """
+    try:
+      st = os.stat(self.path)
+    except OSError as e:
+      print(f'\033[91m=> Failed to stat {self.path}: {e}\033[0m')
+      return None
+    if (st.st_size, st.st_mtime_ns, st.st_ino) == (
+        self.size, self.mtime_ns, self.inode
+    ):
+      return self
+    return FileEntry(
+        path=self.path,
+        size=st.st_size,
+        mtime_ns=st.st_mtime_ns,
+        inode=st.st_ino,
+    )
+
+
+class FileManifest:
+  """Persistent list of the files under root_dir, backed by SQLite.
+
+  scan() lists the directories with os.scandir and reuses the stat results of
+  the entries. A rescan only lists the directories whose mtime changed, i.e.
+  with files added, removed or renamed; the others cost one stat each. Files
+  modified in place don't change the mtime of their directory, use
+  scan(full=True) to pick up their new sizes.
+
+  Paths in the database are relative to root_dir, so the manifest survives the
+  library being mounted elsewhere.
+  """
+
+  def __init__(self, root_dir: str, path: str | None = None):
+    """Opens the manifest at path, defaults to <root_dir>/file_manifest.sqlite.
+
+    Use path=':memory:' to scan without saving the manifest.
+    """
+    self.root_dir = root_dir
+    self.path = path or os.path.join(root_dir, MANIFEST_NAME)
+    self._conn = sqlite3.connect(self.path)
+    self._conn.execute('PRAGMA journal_mode=WAL')
+    self._conn.execute('PRAGMA synchronous=NORMAL')
+    self._conn.execute(
+        'CREATE TABLE IF NOT EXISTS dirs ('
+        'dir TEXT PRIMARY KEY, parent TEXT, mtime_ns INTEGER NOT NULL)'
+    )
+    self._conn.execute(
+        'CREATE TABLE IF NOT EXISTS files ('
+        'dir TEXT NOT NULL, name TEXT NOT NULL, size INTEGER NOT NULL, '
+        'mtime_ns INTEGER NOT NULL, inode INTEGER NOT NULL, '
+        'PRIMARY KEY (dir, name))'
+    )
+    self._conn.execute(
+        'CREATE INDEX IF NOT EXISTS dirs_parent ON dirs (parent)'
+    )
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def close(self):
+    self._conn.commit()
+    self._conn.close()
+
+  def scan(self, full: bool = False) -> dict[str, int]:
+    """Updates the manifest, returns the number of scanned/unchanged dirs."""
+    profiler = utils.current_profiler()
+    stats = {'scanned_dirs': 0, 'unchanged_dirs': 0}
+    known_mtimes = {
+        d: mtime for d, mtime in
+        self._conn.execute('SELECT dir, mtime_ns FROM dirs')
+    }
+    scan_start_ns = time.time_ns()
+
+    # Relative paths of the directories to visit, '' is the root.
+    stack = ['']
+    while stack:
+      rel_dir = stack.pop()
+      full_dir = os.path.join(self.root_dir, rel_dir)
+      try:
+        with profiler.stage('scan_stat'):
+          mtime_ns = os.stat(full_dir).st_mtime_ns
+      except OSError as e:
+        print(f'\033[91m=> Failed to stat {full_dir}: {e}\033[0m')
+        self._delete_dir(rel_dir)
+        continue
+
+      if not full and known_mtimes.get(rel_dir) == mtime_ns:
+        stats['unchanged_dirs'] += 1
+        stack.extend(
+            d for d, in
+            self._conn.execute('SELECT dir FROM dirs WHERE parent = ?', (
+                rel_dir,
+            ))
+        )
+        continue
+
+      stats['scanned_dirs'] += 1
+      with profiler.stage('scan_dir'):
+        files, subdirs = self._scan_dir(full_dir, is_root=rel_dir == '')
+      if files is None:
+        self._delete_dir(rel_dir)
+        continue
+
+      # Forget the removed subdirectories, and everything under them.
+      subdir_set = {os.path.join(rel_dir, d) for d in subdirs}
+      for d, in self._conn.execute(
+          'SELECT dir FROM dirs WHERE parent = ?', (rel_dir,)
+      ).fetchall():
+        if d not in subdir_set:
+          self._delete_dir(d)
+
+      if scan_start_ns - mtime_ns < _RACY_MTIME_NS:
+        mtime_ns = 0  # Rescan next time, see _RACY_MTIME_NS.
+      parent = None if rel_dir == '' else os.path.dirname(rel_dir)
+      self._conn.execute(
+          'INSERT OR REPLACE INTO dirs (dir, parent, mtime_ns) '
+          'VALUES (?, ?, ?)',
+          (rel_dir, parent, mtime_ns),
+      )
+      self._conn.execute('DELETE FROM files WHERE dir = ?', (rel_dir,))
+      self._conn.executemany(
+          'INSERT INTO files (dir, name, size, mtime_ns, inode) '
+          'VALUES (?, ?, ?, ?, ?)',
+          ((rel_dir, *f) for f in files),
+      )
+      # New subdirectories are scanned since they have no known mtime.
+      stack.extend(sorted(subdir_set, reverse=True))
+
+    self._conn.commit()
+    return stats
+
+  def _scan_dir(self, full_dir: str, is_root: bool):
+    """Returns ([(name, size, mtime_ns, inode)], [subdir names]) or Nones."""
+    files = []
+    subdirs = []
+    try:
+      with os.scandir(full_dir) as it:
+        for entry in it:
+          try:
+            # Like os.walk(), don't follow symlinks to directories.
+            if entry.is_dir(follow_symlinks=False):
+              subdirs.append(entry.name)
+              continue
+            if not entry.is_file() or (
+                is_root and entry.name in _MANIFEST_FILES
+            ):
+              continue
+            st = entry.stat()
+            files.append((entry.name, st.st_size, st.st_mtime_ns, st.st_ino))
+          except OSError as e:
+            print(f'\033[91m=> Failed to stat {entry.path}: {e}\033[0m')
+    except OSError as e:
+      print(f'\033[91m=> Failed to scan {full_dir}: {e}\033[0m')
+      return None, None
+    return files, subdirs
+
+  def _delete_dir(self, rel_dir: str):
+    """Forgets the directory and everything under it."""
+    if rel_dir == '':
+      self._conn.execute('DELETE FROM dirs')
+      self._conn.execute('DELETE FROM files')
+      return
+    prefix = rel_dir + os.sep
+    for table in ('dirs', 'files'):
+      self._conn.execute(
+          f'DELETE FROM {table} WHERE dir = ? OR substr(dir, 1, ?) = ?',
+          (rel_dir, len(prefix), prefix),
+      )
+
+  def iter_files(self) -> Iterator[FileEntry]:
+    """Yields the files in the manifest, ordered by directory and name."""
+    for rel_dir, name, size, mtime_ns, inode in self._conn.execute(
+        'SELECT dir, name, size, mtime_ns, inode FROM files ORDER BY dir, name'
+    ):
+      yield FileEntry(
+          path=os.path.join(self.root_dir, rel_dir, name),
+          size=size,
+          mtime_ns=mtime_ns,
+          inode=inode,
+      )
+
+
+def scan_files(
+    root_dir: str, use_manifest: bool = True, full_scan: bool = False
+) -> list[FileEntry]:
+  """Returns all files under root_dir.
+
+  With use_manifest, <root_dir>/file_manifest.sqlite is used and refreshed so
+  only the changed directories are listed, see FileManifest. Otherwise the
+  whole tree is scanned without saving anything. With full_scan, all
+  directories are listed again, to also pick up the files modified in place.
+  """
+  with utils.current_profiler().stage('scan'):
+    with FileManifest(
+        root_dir, path=None if use_manifest else ':memory:'
+    ) as manifest:
+      stats = manifest.scan(full=full_scan)
+      entries = list(manifest.iter_files())
+  print(
+      f'\033[93m=> Found {len(entries)} files under {root_dir}, listed '
+      f'{stats["scanned_dirs"]} directories, {stats["unchanged_dirs"]} '
+      f'unchanged.\033[0m'
+  )
+  return entries
@@ -0,0 +1,179 @@
+import json
+import os
+import sqlite3
+from typing import Any
+from urllib.parse import quote
+
+import utils
+
+
+class HashStore:
+  """Persistent {file_key: {hash_type: hash_value}} map backed by SQLite.
+
+  Unlike a json file, only the new or changed entries are written, and they are
+  committed every `checkpoint_every` writes, so a crash only loses the entries
+  since the last checkpoint.
+
+  Each entry may also have a content hash, to reuse the hash values of a file
+  for its copies, see get_by_content().
+  """
+
+  def __init__(
+      self, path: str, checkpoint_every: int = 1000, read_only: bool = False
+  ):
+    """Opens the store at path.
+
+    With read_only, the store is opened for get() and get_by_content() only,
+    e.g. in worker processes while the main process writes it.
+    """
+    self.path = path
+    self.checkpoint_every = checkpoint_every
+    self._num_pending_writes = 0
+    # Keys accessed by get() or put(), used by prune_unseen().
+    self._seen_keys = set()
+    self.track_seen_keys = False
+    if read_only:
+      # Quote the path, e.g. a '#' or '?' in it would end the path of the URI.
+      uri = f'file:{quote(os.path.abspath(path))}?mode=ro'
+      self._conn = sqlite3.connect(uri, uri=True)
+      return
+
+    self._conn = sqlite3.connect(path)
+    # WAL is faster for many small transactions and keeps the file readable if
+    # the process is killed in the middle of a checkpoint.
+    self._conn.execute('PRAGMA journal_mode=WAL')
+    self._conn.execute('PRAGMA synchronous=NORMAL')
+    self._conn.execute(
+        'CREATE TABLE IF NOT EXISTS hashes ('
+        'file_key TEXT PRIMARY KEY, hash_values TEXT NOT NULL, '
+        'content_hash TEXT)'
+    )
+    # Stores created before content_hash was added.
+    columns = {
+        c for _, c, *_ in self._conn.execute('PRAGMA table_info(hashes)')
+    }
+    if 'content_hash' not in columns:
+      self._conn.execute('ALTER TABLE hashes ADD COLUMN content_hash TEXT')
+    self._conn.execute(
+        'CREATE INDEX IF NOT EXISTS hashes_content_hash '
+        'ON hashes (content_hash)'
+    )
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def __len__(self):
+    return self._conn.execute('SELECT COUNT(*) FROM hashes').fetchone()[0]
+
+  def get(self, key: str) -> dict[str, Any]:
+    """Returns the hash values of the file, or {} if not found."""
+    if self.track_seen_keys:
+      self._seen_keys.add(key)
+    row = self._conn.execute(
+        'SELECT hash_values FROM hashes WHERE file_key = ?', (key,)
+    ).fetchone()
+    return json.loads(row[0]) if row else {}
+
+  def get_by_content(self, content_hash: str) -> dict[str, Any]:
+    """Returns the hash values of any file with the content hash, or {}."""
+    row = self._conn.execute(
+        'SELECT hash_values FROM hashes WHERE content_hash = ? LIMIT 1',
+        (content_hash,)
+    ).fetchone()
+    return json.loads(row[0]) if row else {}
+
+  def put(
+      self,
+      key: str,
+      hash_values: dict[str, Any],
+      content_hash: str | None = None
+  ):
+    """Inserts or replaces the hash values and the content hash of the file."""
+    if self.track_seen_keys:
+      self._seen_keys.add(key)
+    self._conn.execute(
+        'INSERT INTO hashes (file_key, hash_values, content_hash) '
+        'VALUES (?, ?, ?) ON CONFLICT(file_key) DO UPDATE '
+        'SET hash_values = excluded.hash_values, '
+        'content_hash = excluded.content_hash',
+        (key, json.dumps(hash_values, separators=(',', ':')), content_hash),
+    )
+    self._num_pending_writes += 1
+    if self._num_pending_writes >= self.checkpoint_every:
+      self.checkpoint()
+
+  def rewrite_key(self, old_key: str, new_key: str) -> bool:
+    """Moves the entry of old_key to new_key, unless new_key already exists.
+
+    Returns whether the entry was moved.
+    """
+    if self.track_seen_keys:
+      self._seen_keys.add(new_key)
+    cursor = self._conn.execute(
+        'UPDATE OR IGNORE hashes SET file_key = ? WHERE file_key = ?',
+        (new_key, old_key),
+    )
+    if not cursor.rowcount:
+      return False
+    self._num_pending_writes += 1
+    if self._num_pending_writes >= self.checkpoint_every:
+      self.checkpoint()
+    return True
+
+  def checkpoint(self):
+    self._conn.commit()
+    self._num_pending_writes = 0
+
+  def prune_unseen(self) -> int:
+    """Deletes the entries not accessed since track_seen_keys was enabled.
+
+    Returns the number of deleted entries.
+    """
+    assert self.track_seen_keys, 'Need to set track_seen_keys first.'
+    stale_keys = [
+        key for key, in self._conn.execute('SELECT file_key FROM hashes')
+        if key not in self._seen_keys
+    ]
+    self._conn.executemany(
+        'DELETE FROM hashes WHERE file_key = ?', ((k,) for k in stale_keys)
+    )
+    self.checkpoint()
+    return len(stale_keys)
+
+  def close(self):
+    self.checkpoint()
+    self._conn.close()
+
+  def migrate_from_json(self, json_path: str) -> int:
+    """Imports the entries of a hash_all.json file, returns the number of them.
+
+    The json file is left untouched.
+    """
+    file_key_to_hash = utils.load_json_or(json_path, {})
+    self._conn.executemany(
+        'INSERT OR REPLACE INTO hashes (file_key, hash_values) VALUES (?, ?)',
+        (
+            (key, json.dumps(hash_values, separators=(',', ':')))
+            for key, hash_values in file_key_to_hash.items()
+        ),
+    )
+    self.checkpoint()
+    return len(file_key_to_hash)
+
+
+def open_hash_store(src_root_dir: str, **kwargs) -> HashStore:
+  """Opens the hash store of src_root_dir, migrating hash_all.json if needed."""
+  store_path = os.path.join(src_root_dir, 'hash_all.sqlite')
+  json_path = os.path.join(src_root_dir, 'hash_all.json')
+  need_migration = not os.path.exists(store_path) and os.path.exists(json_path)
+  store = HashStore(store_path, **kwargs)
+  if need_migration:
+    num_migrated = store.migrate_from_json(json_path)
+    print(
+        f'\033[93m=> Migrated {num_migrated} entries from {json_path} to '
+        f'{store_path}, the json file is no longer used.\033[0m'
+    )
+  return store
@@ -1,34 +1,118 @@
+import json
 import os
 import shutil
 
+import file_manifest
 import utils
 
 
-def move_files(src_root_dir: str, dst_root_dir: str, debug: bool):
-  """Move files from src_root_dir to dst_root_dir with the same dir structure."""
+def move_files(
+    src_root_dir: str,
+    dst_root_dir: str,
+    debug: bool,
+    use_manifest: bool = True,
+    full_scan: bool = False,
+):
+  """Move files from src_root_dir to dst_root_dir with the same dir structure.
+
+  See file_manifest.scan_files() for use_manifest and full_scan.
+  """
   i = 0
-  for cur_dir, _, files in os.walk(src_root_dir):
-    for file in files:
-      src_path = os.path.join(cur_dir, file)
-      for suffix in ('.ds_store',):
-        if src_path.lower().endswith(suffix):
-          print(f'\033[93m=> Skipping {src_path}\033[0m')
-          continue
-
-      relative_path = os.path.relpath(src_path, src_root_dir)
-      dst_path = os.path.join(dst_root_dir, relative_path)
-      if debug:
-        print(f'\033[93m=> {src_path}\033[0m')
-        print(f'{dst_path}')
-        i += 1
-        if i > 30:
-          return
-      else:
-        utils.safe_move(src_path, dst_path)
+  profiler = utils.Profiler('move_files')
+  mover = utils.BulkMover()
+  for entry in file_manifest.scan_files(
+      src_root_dir, use_manifest, full_scan
+  ):
+    profiler.progress()
+    src_path = entry.path
+    if src_path.lower().endswith('.ds_store') or (
+        os.path.basename(src_path) == utils.MOVE_JOURNAL_NAME
+    ):
+      print(f'\033[93m=> Skipping {src_path}\033[0m')
+      continue
+
+    relative_path = os.path.relpath(src_path, src_root_dir)
+    dst_path = os.path.join(dst_root_dir, relative_path)
+    if debug:
+      print(f'\033[93m=> {src_path}\033[0m')
+      print(f'{dst_path}')
+      i += 1
+      if i > 30:
+        return
+    else:
+      mover.add(src_path, dst_path)
+  # Nothing is moved if any file already exists in dst_root_dir.
+  mover.run()
+  profiler.print_summary()
+
+
+def undo_moves(journal_path: str, run_id: str | None = None) -> int:
+  """Moves the files of a run back to where they were, returns how many.
+
+  Only the files in the journal written by utils.BulkMover are touched, so this
+  is much faster than move_files() of the whole destination tree, and also
+  works for files renamed when moved, e.g. by cleanup_images() with
+  keep_dir_structture=False.
+
+  The undo is journaled as run 'undo-<run_id>', so running it again only moves
+  the files that couldn't be moved back the first time, e.g. because their
+  original path was taken.
+
+  Args:
+    journal_path: Path of the journal, <dst_root_dir>/move_journal.jsonl.
+    run_id: The run to undo. Defaults to the last run that is not an undo.
+  """
+  entries = []
+  with open(journal_path) as f:
+    for line in f:
+      if line.strip():
+        entries.append(json.loads(line))
+
+  if run_id is None:
+    runs = [e['run'] for e in entries if not e['run'].startswith('undo-')]
+    if not runs:
+      print(f'\033[93m=> Nothing to undo in {journal_path}\033[0m')
+      return 0
+    run_id = runs[-1]
+
+  undo_run_id = f'undo-{run_id}'
+  # (src, dst) of the moves already undone, as (dst, src) of the run.
+  undone = {(e['dst'], e['src']) for e in entries if e['run'] == undo_run_id}
+  mover = utils.BulkMover(journal_path=journal_path, run_id=undo_run_id)
+  # Undo in the reverse order, in case a file was moved more than once.
+  for e in reversed(entries):
+    if e['run'] == run_id and (e['src'], e['dst']) not in undone:
+      mover.add(e['dst'], e['src'])
+  num_to_undo = len(mover)
+
+  # Files whose original path is taken are reported and left in place.
+  moved = mover.run(on_collision='skip')
+  print(
+      f'\033[93m=> Moved back {len(moved)}/{num_to_undo} files of run '
+      f'{run_id}.\033[0m'
+  )
+  return len(moved)
 
 
 if __name__ == '__main__':
   src_root_dir = '/Users/laigd/.Trash/2'
   dst_root_dir = '/Users/laigd/Documents/images/eee/网页'
   debug = False
-  move_files(src_root_dir=src_root_dir, dst_root_dir=dst_root_dir, debug=debug)
+
+  # Whether to list all directories again, to pick up the files modified in
+  # place, which the manifest misses.
+  full_scan = False
+
+  # When set, undo the last run journaled there instead, e.g.
+  # os.path.join(src_root_dir, utils.MOVE_JOURNAL_NAME).
+  journal_path = None
+
+  if journal_path:
+    undo_moves(journal_path)
+  else:
+    move_files(
+        src_root_dir=src_root_dir,
+        dst_root_dir=dst_root_dir,
+        debug=debug,
+        full_scan=full_scan,
+    )
@@ -0,0 +1,333 @@
+import json
+import os
+import shutil
+from typing import Any, Iterable, Sequence
+
+import numpy as np
+
+import utils
+
+# A detection of the predictor, the class is the index in the class names of
+# the store.
+DETECTION_DTYPE = np.dtype([
+    ('class_id', '<u1'),
+    # float64 like the scores of the predictors, float32 would change them.
+    ('score', '<f8'),
+    ('box', '<i4', (4,)),  # x, y, w, h
+])
+# Record of a file. Its detections are detections[start:start + count].
+_FILE_DTYPE = np.dtype([
+    ('start', '<u8'),
+    ('count', '<u4'),
+    ('md5', 'V16'),
+])
+_NO_MD5 = bytes(16)  # md5 of the files whose md5 is unknown.
+_VERSION = 2
+
+
+def to_detections(
+    metrics: list[dict[str, Any]], class_ids: dict[str, int]
+) -> np.ndarray:
+  """Converts the [{'class', 'score', 'box'}] of a predictor to an array."""
+  detections = np.empty(len(metrics), DETECTION_DTYPE)
+  for i, metric in enumerate(metrics):
+    detections[i] = (class_ids[metric['class']], metric['score'], metric['box'])
+  return detections
+
+
+def to_dicts(
+    detections: np.ndarray, class_names: Sequence[str]
+) -> list[dict[str, Any]]:
+  """The reverse of to_detections()."""
+  return [
+      {'class': class_names[class_id], 'score': score, 'box': box.tolist()}
+      for class_id, score, box in detections.tolist()
+  ]
+
+
+class PredictionStore:
+  """Persistent {file_key: detections} map, stored as memory mapped columns.
+
+  The store is a directory of:
+  - meta.json: the class names, the classes are saved as their indices.
+  - detections.bin: DETECTION_DTYPE records of all files.
+  - files.bin: _FILE_DTYPE records, the detections and the md5 of each file.
+  - keys.txt: the key of each file record, one per line.
+  New files are appended to them, and made durable by flush(). get() returns a
+  read-only view of the memory mapped detections, not python objects. Keys
+  added again point to the new record, the old one is dropped by compact().
+
+  A crash in the middle of an append leaves a partial record at the end, it's
+  ignored when the store is opened.
+  """
+
+  def __init__(self, dir_path: str, class_names: Sequence[str]):
+    self.dir_path = dir_path
+    self.class_names = tuple(class_names)
+    self._class_ids = {name: i for i, name in enumerate(self.class_names)}
+    assert len(self.class_names) <= 256, 'Class ids are stored as uint8.'
+    self._open()
+
+  def _open(self):
+    dir_path = self.dir_path
+    os.makedirs(dir_path, exist_ok=True)
+    meta_path = os.path.join(dir_path, 'meta.json')
+    meta = utils.load_json_or(meta_path, None)
+    if meta is None:
+      utils.dump_json(
+          meta_path, {'version': _VERSION, 'class_names': self.class_names}
+      )
+    elif meta.get('version') != _VERSION:
+      raise ValueError(
+          f'{dir_path} is of version {meta.get("version")}, not {_VERSION}. '
+          f'Remove it to predict again.'
+      )
+    elif tuple(meta['class_names']) != self.class_names:
+      raise ValueError(
+          f'{dir_path} has classes {meta["class_names"]}, not '
+          f'{self.class_names}. Remove it to predict again.'
+      )
+
+    keys = []
+    if os.path.exists(self._path('keys.txt')):
+      with open(self._path('keys.txt'), encoding='utf-8', newline='\n') as f:
+        keys = f.read().split('\n')[:-1]  # The last one may be partial.
+    num_files = min(len(keys), self._num_records('files.bin', _FILE_DTYPE))
+    files = self._map('files.bin', _FILE_DTYPE, num_files)
+    num_detections = self._num_records('detections.bin', DETECTION_DTYPE)
+    # Drop the files whose detections were not fully written.
+    while num_files and (
+        files[num_files - 1]['start'] + files[num_files - 1]['count']
+        > num_detections
+    ):
+      num_files -= 1
+    num_detections = int(
+        files[num_files - 1]['start'] + files[num_files - 1]['count']
+    ) if num_files else 0
+    self._truncate(keys[:num_files], num_files, num_detections)
+
+    self._keys = keys[:num_files]
+    # (start, count) of each file, python ints are much faster to index than
+    # the records of the memory map.
+    self._spans = list(
+        zip(
+            files['start'][:num_files].tolist(),
+            files['count'][:num_files].tolist()
+        )
+    )
+    self._key_to_row = {key: row for row, key in enumerate(self._keys)}
+    self._num_detections = num_detections
+    self._content_to_row = None  # Built on first use, see find_by_content().
+    self._files_f = open(self._path('files.bin'), 'ab')
+    self._detections_f = open(self._path('detections.bin'), 'ab')
+    self._keys_f = open(
+        self._path('keys.txt'), 'a', encoding='utf-8', newline='\n'
+    )
+    self._remap()
+
+  def _path(self, name: str) -> str:
+    return os.path.join(self.dir_path, name)
+
+  def _num_records(self, name: str, dtype: np.dtype) -> int:
+    path = self._path(name)
+    if not os.path.exists(path):
+      return 0
+    return os.path.getsize(path) // dtype.itemsize
+
+  def _map(self, name: str, dtype: np.dtype, num_records: int) -> np.ndarray:
+    if not num_records:  # Empty files can't be memory mapped.
+      return np.zeros(0, dtype)
+    return np.memmap(self._path(name), dtype, 'r', shape=(num_records,))
+
+  def _truncate(self, keys: list[str], num_files: int, num_detections: int):
+    """Cuts the partial records at the end of the files."""
+    for name, size in (
+        ('files.bin', num_files * _FILE_DTYPE.itemsize),
+        ('detections.bin', num_detections * DETECTION_DTYPE.itemsize),
+    ):
+      path = self._path(name)
+      if os.path.exists(path) and os.path.getsize(path) > size:
+        os.truncate(path, size)
+    keys_size = sum(len(key.encode('utf-8')) + 1 for key in keys)
+    if os.path.exists(self._path('keys.txt')) and os.path.getsize(
+        self._path('keys.txt')
+    ) > keys_size:
+      os.truncate(self._path('keys.txt'), keys_size)
+
+  def _remap(self):
+    self._files = self._map('files.bin', _FILE_DTYPE, len(self._keys))
+    # Slices of a plain array are cheaper than those of a memmap.
+    self._detections = np.asarray(
+        self._map('detections.bin', DETECTION_DTYPE, self._num_detections)
+    )
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def __len__(self):
+    return len(self._key_to_row)
+
+  def __contains__(self, key: str) -> bool:
+    return key in self._key_to_row
+
+  def keys(self) -> Iterable[str]:
+    return self._key_to_row.keys()
+
+  def get(self, key: str) -> np.ndarray | None:
+    """Returns the DETECTION_DTYPE detections of the file, or None."""
+    row = self._key_to_row.get(key)
+    if row is None:
+      return None
+    start, count = self._spans[row]
+    if start + count > len(self._detections):  # Appended since the flush().
+      self.flush()
+    return self._detections[start:start + count]
+
+  def get_content_hash(self, key: str) -> str | None:
+    """Returns the md5 of the file as hex, or None if unknown."""
+    row = self._key_to_row.get(key)
+    if row is None:
+      return None
+    if row >= len(self._files):
+      self.flush()
+    md5 = self._files[row]['md5'].tobytes()
+    return None if md5 == _NO_MD5 else md5.hex()
+
+  def find_by_content(self, content_hash: str) -> str | None:
+    """Returns the key of a file with the md5, or None."""
+    if self._content_to_row is None:
+      self.flush()
+      self._content_to_row = {}
+      for row, md5 in enumerate(self._files['md5'].tolist()):
+        if md5 != _NO_MD5:
+          self._content_to_row.setdefault(md5, row)
+    row = self._content_to_row.get(bytes.fromhex(content_hash))
+    return None if row is None else self._keys[row]
+
+  def append(
+      self,
+      key: str,
+      detections: np.ndarray | list[dict[str, Any]],
+      content_hash: str | None = None,
+  ):
+    """Adds or replaces the detections of the file.
+
+    The detections are either an array from get(), or the
+    [{'class', 'score', 'box'}] of a predictor.
+    """
+    if not isinstance(detections, np.ndarray):
+      detections = to_detections(detections, self._class_ids)
+    md5 = bytes.fromhex(content_hash) if content_hash else _NO_MD5
+    record = np.array([(self._num_detections, len(detections), md5)],
+                      _FILE_DTYPE)
+    self._detections_f.write(detections.astype(DETECTION_DTYPE).tobytes())
+    self._files_f.write(record.tobytes())
+    self._keys_f.write(key + '\n')
+    row = len(self._keys)
+    self._keys.append(key)
+    self._spans.append((self._num_detections, len(detections)))
+    self._key_to_row[key] = row
+    self._num_detections += len(detections)
+    if md5 != _NO_MD5 and self._content_to_row is not None:
+      self._content_to_row.setdefault(md5, row)
+
+  def flush(self):
+    """Writes the appended files, and maps them for get()."""
+    # Keys last, so the other records of a key are complete when it's read.
+    for f in (self._detections_f, self._files_f, self._keys_f):
+      f.flush()
+      os.fsync(f.fileno())
+    self._remap()
+
+  @property
+  def num_records(self) -> int:
+    """Number of file records, including the ones replaced by a later one."""
+    return len(self._keys)
+
+  def compact(self, keys_to_keep: Iterable[str] | None = None):
+    """Rewrites the store with only the latest record of keys_to_keep.
+
+    Keeps all keys if keys_to_keep is None. The new store is written next to
+    this one and then swapped in.
+    """
+    self.flush()
+    keys_to_keep = self._key_to_row.keys() if keys_to_keep is None else (
+        k for k in keys_to_keep if k in self._key_to_row
+    )
+    tmp_dir = self.dir_path + '.tmp'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    with PredictionStore(tmp_dir, self.class_names) as new_store:
+      for key in keys_to_keep:
+        start, count = self._spans[self._key_to_row[key]]
+        new_store.append(
+            key, self._detections[start:start + count],
+            self.get_content_hash(key)
+        )
+    self.close()
+    old_dir = self.dir_path + '.old'
+    shutil.rmtree(old_dir, ignore_errors=True)
+    os.rename(self.dir_path, old_dir)
+    os.rename(tmp_dir, self.dir_path)
+    shutil.rmtree(old_dir)
+    self._open()
+
+  def close(self):
+    self.flush()
+    for f in (self._detections_f, self._files_f, self._keys_f):
+      f.close()
+
+  def migrate_from_json(
+      self,
+      json_path: str,
+      content_json_path: str | None = None,
+      partial_path: str | None = None,
+  ) -> int:
+    """Imports a prediction_result-<name>.json, returns the number of files.
+
+    The {key: md5} of content_json_path and the [key, metrics, md5] lines of
+    partial_path, written by older versions, are imported too if they exist.
+    The json files are left untouched.
+    """
+    predictions = utils.load_json_or(json_path, {})
+    content_hashes = {}
+    if content_json_path:
+      content_hashes = utils.load_json_or(content_json_path, {})
+    if partial_path and os.path.exists(partial_path):
+      with open(partial_path) as f:
+        for line in f:
+          try:
+            key, metrics, *content_hash = json.loads(line)
+          except ValueError:
+            continue  # The last line may be cut by a crash.
+          predictions[key] = metrics
+          if content_hash and content_hash[0]:
+            content_hashes[key] = content_hash[0]
+    for key, metrics in predictions.items():
+      self.append(key, metrics, content_hashes.get(key))
+    self.flush()
+    return len(predictions)
+
+
+def open_prediction_store(
+    src_root_dir: str, predictor_name: str, class_names: Sequence[str]
+) -> PredictionStore:
+  """Opens the store of the predictor, migrating its json files if needed."""
+  prefix = os.path.join(src_root_dir, f'prediction_result-{predictor_name}')
+  store_dir = prefix + '.store'
+  json_path = prefix + '.json'
+  need_migration = not os.path.exists(store_dir) and (
+      os.path.exists(json_path) or os.path.exists(prefix + '.partial.jsonl')
+  )
+  store = PredictionStore(store_dir, class_names)
+  if need_migration:
+    num_migrated = store.migrate_from_json(
+        json_path, prefix + '.content.json', prefix + '.partial.jsonl'
+    )
+    print(
+        f'\033[93m=> Migrated {num_migrated} predictions from {json_path} to '
+        f'{store_dir}, the json files are no longer used.\033[0m'
+    )
+  return store
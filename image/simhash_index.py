@@ -0,0 +1,159 @@
+import collections
+from typing import Any, Sequence
+
+import numpy as np
+
+# Chunks narrower than this put too many unrelated hashes into the same bucket,
+# and comparing the bucket members becomes quadratic. See _min_chunk_bits() for
+# more hashes.
+_MIN_CHUNK_BITS = 12
+# Chunks are stored as np.uint64.
+_MAX_CHUNK_BITS = 64
+
+
+def _min_chunk_bits(num_hashes: int) -> int:
+  """The min chunk width for the buckets of num_hashes random hashes to hold
+  about one hash each, so cluster() compares about num_hashes pairs per chunk.
+  """
+  return max(_MIN_CHUNK_BITS, (num_hashes - 1).bit_length())
+
+
+class MultiIndexHash:
+  """Multi-index hashing for Hamming distance range queries.
+
+  Each hash is split into max_distance + 1 disjoint chunks. By the pigeonhole
+  principle, two hashes within max_distance bits must have at least one
+  identical chunk, so only the hashes sharing a chunk with the query need to be
+  compared. Each chunk is indexed as a sorted np.uint64 array, so building the
+  index for millions of hashes takes a few seconds. The chunks need at least
+  log2(len(hashes)) bits, see supports().
+  See: Norouzi et al., "Fast Search in Hamming Space with Multi-Index Hashing".
+  """
+
+  def __init__(self, hashes: Sequence[int], num_bits: int, max_distance: int):
+    if not self.supports(num_bits, max_distance, len(hashes)):
+      raise ValueError(
+          f'Unsupported {num_bits=} for {max_distance=} and {len(hashes)} '
+          f'hashes, each chunk needs {_min_chunk_bits(len(hashes))} to '
+          f'{_MAX_CHUNK_BITS} bits.'
+      )
+    self.hashes = hashes
+    self.max_distance = max_distance
+
+    num_chunks = max_distance + 1
+    # (shift, mask, sorted chunk values, hash ids in the same order) per chunk.
+    self._chunks = []
+    start = 0
+    for i in range(num_chunks):
+      end = num_bits * (i + 1) // num_chunks
+      mask = (1 << (end - start)) - 1
+      values = np.fromiter(
+          ((hash_val >> start) & mask for hash_val in hashes), np.uint64,
+          len(hashes)
+      )
+      order = np.argsort(values, kind='stable')
+      self._chunks.append((start, mask, values[order], order))
+      start = end
+
+  @staticmethod
+  def supports(num_bits: int, max_distance: int, num_hashes: int = 0) -> bool:
+    """Whether the hashes can be indexed, without cluster() being quadratic.
+
+    Narrower chunks put num_hashes / 2**chunk_bits random hashes per bucket,
+    e.g. 1M 50-bit hashes within 3 bits have 12-bit chunks, so about 250 hashes
+    per bucket. Real simhashes are more skewed than random ones.
+    """
+    num_chunks = max_distance + 1
+    return (
+        num_bits // num_chunks >= _min_chunk_bits(num_hashes)
+        and -(-num_bits // num_chunks) <= _MAX_CHUNK_BITS
+    )
+
+  def query(self, hash_val: int) -> list[int]:
+    """Returns the ids of all hashes within max_distance bits of hash_val.
+
+    The id of a hash is its index in self.hashes.
+    """
+    found = set()
+    for shift, mask, values, order in self._chunks:
+      chunk = np.uint64((hash_val >> shift) & mask)
+      lo = np.searchsorted(values, chunk, side='left')
+      hi = np.searchsorted(values, chunk, side='right')
+      for hash_id in order[lo:hi].tolist():
+        if hash_id in found:
+          continue
+        if (self.hashes[hash_id] ^ hash_val).bit_count() <= self.max_distance:
+          found.add(hash_id)
+    return sorted(found)
+
+  def cluster(self) -> list[list[int]]:
+    """Groups the hashes into connected components of near duplicates.
+
+    Two hashes are in the same component if there is a chain of hashes between
+    them where each step is within max_distance bits, so the hashes of a
+    component can be more than max_distance bits apart. Returns the components
+    as lists of hash ids, in the order of self.hashes.
+    """
+    parent = list(range(len(self.hashes)))
+
+    def find(i):
+      while parent[i] != i:
+        parent[i] = parent[parent[i]]
+        i = parent[i]
+      return i
+
+    hashes = self.hashes
+    for _, _, values, order in self._chunks:
+      # Only the runs of equal chunk values, i.e. buckets with at least two
+      # hashes, need to be compared.
+      run_starts = np.flatnonzero(np.diff(values)) + 1
+      bounds = np.concatenate(([0], run_starts, [len(values)]))
+      for lo, hi in zip(bounds[:-1].tolist(), bounds[1:].tolist()):
+        if hi - lo < 2:
+          continue
+        bucket = order[lo:hi].tolist()
+        for i, id1 in enumerate(bucket):
+          hash1 = hashes[id1]
+          for id2 in bucket[i + 1:]:
+            root1, root2 = find(id1), find(id2)
+            if root1 == root2:
+              continue
+            if (hash1 ^ hashes[id2]).bit_count() <= self.max_distance:
+              parent[max(root1, root2)] = min(root1, root2)
+
+    components = collections.defaultdict(list)
+    for hash_id in range(len(hashes)):
+      components[find(hash_id)].append(hash_id)
+    return list(components.values())
+
+
+def group_near_duplicates(
+    hash_to_files: dict[int, list[Any]],
+    num_bits: int,
+    max_distance: int,
+) -> dict[str, list[Any]]:
+  """Merges the groups of matching simhashes into near duplicate groups.
+
+  Args:
+    hash_to_files: Maps a simhash value to the files with that value, e.g. the
+      utils.ImageFileMeta or the utils.FileTable row ids of the files.
+    num_bits: Number of bits of the simhashes.
+    max_distance: Max Hamming distance between two neighboring hashes of a
+      group. The groups are chains of neighbors, so two files of a group can be
+      further apart, see MultiIndexHash.cluster().
+
+  Returns:
+    A {group_name: files} dict that can be passed to
+    utils.generate_html() and maybe_move(). The group name is the hex of the
+    first hash of the group.
+  """
+  hash_vals = list(hash_to_files.keys())
+  index = MultiIndexHash(hash_vals, num_bits, max_distance)
+
+  groups = {}
+  for component in index.cluster():
+    files = []
+    for hash_id in component:
+      files.extend(hash_to_files[hash_vals[hash_id]])
+    groups[f'{hash_vals[component[0]]:#x}~{max_distance}'] = files
+  return groups
@@ -1,6 +1,12 @@
+import array
 import collections
+import concurrent.futures
+import contextlib
 import dataclasses
+import errno
 import hashlib
+import html
+import io
 import json
 import os
 import random
@@ -8,9 +14,13 @@ import re
 import shutil
 import string
 import sys
-from typing import Any
+import threading
+import time
+from typing import Any, Callable, Iterable, Mapping, Sequence
 from urllib.parse import quote
 
+from PIL import Image
+
 
 def load_json_or(path: str, default_value: Any):
   loaded = default_value
@@ -21,8 +31,20 @@ def load_json_or(path: str, default_value: Any):
 
 
 def dump_json(path: str, value: Any):
-  with open(path, 'w') as f:
+  # Write to a temp file first, so a crash never leaves a truncated file.
+  tmp_path = path + '.tmp'
+  with open(tmp_path, 'w') as f:
     json.dump(value, f, indent=2)
+  os.replace(tmp_path, path)
+
+
+def md5_of_file(file_path: str, chunk_size: int = 2**20) -> str:
+  """MD5 of the content of the file, read chunk_size bytes at a time."""
+  hash_md5 = hashlib.md5()
+  with open(file_path, 'rb') as f:
+    while chunk := f.read(chunk_size):
+      hash_md5.update(chunk)
+  return hash_md5.hexdigest()
 
 
 def make_dataclass(*args, **kwargs):
@@ -35,11 +57,253 @@ def make_dataclass(*args, **kwargs):
   return dataclasses.dataclass(*args, kw_only=True, **kwargs)
 
 
+def pipelined_batches(
+    items: Sequence[Any],
+    load_fn: Callable[[Any], Any],
+    process_fn: Callable[[list[Any]], list[Any]],
+    batch_size: int,
+    num_threads: int = 4,
+    prefetch_batches: int = 2,
+) -> list[Any]:
+  """Processes the items in batches, loading the next batches meanwhile.
+
+  load_fn runs on each item in a pool of num_threads threads, at most
+  prefetch_batches batches ahead of the batch being processed, so only that
+  many loaded batches are in memory. process_fn runs in the calling thread on
+  each list of loaded items, and returns one result per item. This overlaps
+  e.g. the image decoding with the inference, as long as both release the GIL.
+
+  Returns:
+    The results of all items, in order.
+  """
+  profiler = current_profiler()
+  batches = [items[i:i + batch_size] for i in range(0, len(items), batch_size)]
+  results = []
+  with concurrent.futures.ThreadPoolExecutor(num_threads) as executor:
+    # Futures of the loaded items of the batches being loaded, in order.
+    in_flight = collections.deque()
+    next_batch = 0
+
+    def load_next_batch():
+      nonlocal next_batch
+      if next_batch < len(batches):
+        in_flight.append(
+            [executor.submit(load_fn, item) for item in batches[next_batch]]
+        )
+        next_batch += 1
+
+    for _ in range(prefetch_batches + 1):
+      load_next_batch()
+    while in_flight:
+      with profiler.stage('load_wait'):
+        loaded = [future.result() for future in in_flight.popleft()]
+      with profiler.stage('process'):
+        results.extend(process_fn(loaded))
+      load_next_batch()
+  return results
+
+
+class _Stage:
+  """Context manager that adds its wall time to a stage of a Profiler."""
+  __slots__ = ('_profiler', '_name', '_start')
+
+  def __init__(self, profiler: 'Profiler', name: str):
+    self._profiler = profiler
+    self._name = name
+
+  def __enter__(self):
+    self._start = time.perf_counter()
+
+  def __exit__(self, *args):
+    self._profiler.add_stage_time(
+        self._name, time.perf_counter() - self._start
+    )
+
+
+# Returned by Profiler.stage() when disabled.
+_NULL_STAGE = contextlib.nullcontext()
+
+
+class Profiler:
+  """Stage timers, counters and progress of a pipeline.
+
+  Usage:
+    profiler = utils.Profiler('dedup', enabled=True)
+    with utils.profiling(profiler):
+      for file in files:
+        with profiler.stage('read'):
+          ...
+        profiler.count('cache_hits')
+        profiler.progress()  # One item done.
+    profiler.print_summary()
+    profiler.dump(json_path)
+
+  Stages can be nested, their times are inclusive. When disabled, stage()
+  returns a shared no-op context manager and count() returns right away, so the
+  instrumentation costs a method call. progress() prints the throughput and the
+  ETA every progress_every items even when disabled, set it to 0 to never print.
+  Not thread safe, only use it from the thread that runs the pipeline.
+  """
+
+  def __init__(
+      self,
+      name: str,
+      enabled: bool = False,
+      total: int | None = None,
+      progress_every: int = 1000,
+      unit: str = 'files',
+  ):
+    self.name = name
+    self.enabled = enabled
+    # Total number of items, for the ETA. Can be set later once known.
+    self.total = total
+    self.progress_every = progress_every
+    self.unit = unit
+    self.num_done = 0
+    self.stage_secs = collections.defaultdict(float)
+    self.stage_calls = collections.defaultdict(int)
+    self.counters = collections.defaultdict(int)
+    self._start = time.perf_counter()
+
+  def stage(self, name: str):
+    if not self.enabled:
+      return _NULL_STAGE
+    return _Stage(self, name)
+
+  def add_stage_time(self, name: str, secs: float, calls: int = 1):
+    self.stage_secs[name] += secs
+    self.stage_calls[name] += calls
+
+  def count(self, name: str, n: int = 1):
+    if self.enabled:
+      self.counters[name] += n
+
+  def progress(self, n: int = 1):
+    """Marks n more items as done, and prints the progress if due."""
+    prev_done = self.num_done
+    self.num_done += n
+    if (
+        self.progress_every
+        and self.num_done // self.progress_every
+        != prev_done // self.progress_every
+    ):
+      print(f'\033[93m=> {self.progress_message()}\033[0m')
+
+  def progress_message(self) -> str:
+    secs = time.perf_counter() - self._start
+    rate = self.num_done / secs if secs > 0 else 0
+    message = f'{self.name}: {self.num_done}'
+    if self.total:
+      message += f'/{self.total}'
+    message += f' {self.unit}, {rate:.1f} {self.unit}/s'
+    if self.total and rate > 0:
+      eta = max(self.total - self.num_done, 0) / rate
+      message += f', ETA {eta // 3600:.0f}:{eta % 3600 // 60:02.0f}:'
+      message += f'{eta % 60:02.0f}'
+    return message
+
+  def take_snapshot(self) -> dict[str, Any]:
+    """Returns the stage times and counters since the last snapshot.
+
+    Used to send the measurements of a worker process to the main one, see
+    merge().
+    """
+    snapshot = {
+        'stage_secs': dict(self.stage_secs),
+        'stage_calls': dict(self.stage_calls),
+        'counters': dict(self.counters),
+    }
+    self.stage_secs.clear()
+    self.stage_calls.clear()
+    self.counters.clear()
+    return snapshot
+
+  def merge(self, snapshot: dict[str, Any] | None):
+    """Adds the measurements returned by take_snapshot() of another profiler."""
+    if not snapshot:
+      return
+    for name, secs in snapshot['stage_secs'].items():
+      self.add_stage_time(name, secs, snapshot['stage_calls'][name])
+    for name, n in snapshot['counters'].items():
+      self.counters[name] += n
+
+  def summary(self) -> dict[str, Any]:
+    wall_secs = time.perf_counter() - self._start
+    return {
+        'name': self.name,
+        'wall_secs': wall_secs,
+        f'num_{self.unit}': self.num_done,
+        f'{self.unit}_per_sec': self.num_done / wall_secs,
+        # Stages in worker processes or threads can add up to more than the
+        # wall time.
+        'stages': {
+            name: {
+                'secs': secs,
+                'calls': self.stage_calls[name],
+                'ms_per_call': 1000 * secs / self.stage_calls[name],
+            } for name, secs in
+            sorted(self.stage_secs.items(), key=lambda kv: -kv[1])
+        },
+        'counters': dict(sorted(self.counters.items())),
+    }
+
+  def print_summary(self):
+    summary = self.summary()
+    print(
+        f'\033[93m=> {self.progress_message()}, took '
+        f'{summary["wall_secs"]:.2f}s.\033[0m'
+    )
+    if not self.enabled:
+      return
+    print(f'{"stage":<24}{"secs":>10}{"calls":>10}{"ms/call":>10}')
+    for name, stage in summary['stages'].items():
+      print(
+          f'{name:<24}{stage["secs"]:>10.2f}{stage["calls"]:>10}'
+          f'{stage["ms_per_call"]:>10.2f}'
+      )
+    for name, n in summary['counters'].items():
+      print(f'{name:<24}{n:>10}')
+
+  def dump(self, path: str):
+    dump_json(path, self.summary())
+
+
+# Used by the code not running under profiling().
+_NULL_PROFILER = Profiler('null', progress_every=0)
+_current_profiler = _NULL_PROFILER
+
+
+def current_profiler() -> Profiler:
+  """Returns the profiler of the innermost profiling() block.
+
+  Lets the code deep in a pipeline, e.g. the dedupers, report without passing
+  the profiler around.
+  """
+  return _current_profiler
+
+
+@contextlib.contextmanager
+def profiling(profiler: Profiler):
+  global _current_profiler
+  prev_profiler = _current_profiler
+  _current_profiler = profiler
+  try:
+    yield profiler
+  finally:
+    _current_profiler = prev_profiler
+
+
 def should_skip(filename: str, size: int = None):
+  # The files of prediction_store.PredictionStore, in
+  # prediction_result-<name>.store/ or its .store.tmp/ while compacted.
+  store_dir = os.path.basename(os.path.dirname(filename))
+  if store_dir.startswith('prediction_result-') and '.store' in store_dir:
+    return True
   # yapf: disable
   for suffix in (
       '.ds_store',  # System files
-      '.html', '.json', '.py',  # Developer files
+      '.html', '.json', '.jsonl', '.py',  # Developer files
+      '.sqlite', '.sqlite-shm', '.sqlite-wal',  # Caches
       '.avi', '.mov', '.mp4',  # Videos
       '.txt',  # Notes
       '.webp',  # opencv-python / cv2 can't read webp
@@ -52,6 +316,99 @@ def should_skip(filename: str, size: int = None):
   return False
 
 
+# See more mime types in: http://en.wikipedia.org/wiki/List_of_file_signatures
+# The formats of imgMimeType() in browser_image_viewer/main.js, but any JPEG
+# marker is accepted after ff d8 ff, not only e0, e1, ee and db.
+_IMAGE_MAGICS = (
+    (b'\x89PNG', 'png'),
+    (b'GIF8', 'gif'),
+    (b'\xff\xd8\xff', 'jpeg'),
+    (b'RIFF', 'webp'),
+    (b'BM', 'bmp'),
+)
+
+# Number of bytes to read to parse the image size. Large enough for the EXIF
+# thumbnails that precede the size in most JPEGs.
+_IMAGE_HEADER_BYTES = 64 * 1024
+
+
+def sniff_image_format(header: bytes) -> str | None:
+  """Returns the image format from the magic bytes, or None if unknown."""
+  for magic, fmt in _IMAGE_MAGICS:
+    if header.startswith(magic):
+      return fmt
+  return None
+
+
+def _parse_jpeg_size(file_bytes: bytes):
+  i = 2  # Skip SOI.
+  while i + 9 < len(file_bytes):
+    if file_bytes[i] != 0xff:
+      return None
+    marker = file_bytes[i + 1]
+    if marker == 0xff:  # Fill byte.
+      i += 1
+      continue
+    if marker == 0x01 or 0xd0 <= marker <= 0xd8:  # Markers without a length.
+      i += 2
+      continue
+    if marker in (0xd9, 0xda):  # EOI or SOS, no frame header before the data.
+      return None
+    # SOFn, except DHT (c4), JPG (c8) and DAC (cc).
+    if 0xc0 <= marker <= 0xcf and marker not in (0xc4, 0xc8, 0xcc):
+      h = int.from_bytes(file_bytes[i + 5:i + 7], 'big')
+      w = int.from_bytes(file_bytes[i + 7:i + 9], 'big')
+      return (w, h) if w and h else None
+    i += 2 + int.from_bytes(file_bytes[i + 2:i + 4], 'big')
+  return None
+
+
+def _parse_image_size(file_bytes: bytes):
+  """Parses (width, height) from the header of common formats, or None."""
+  fmt = sniff_image_format(file_bytes)
+  if fmt == 'png' and file_bytes[12:16] == b'IHDR':
+    return (
+        int.from_bytes(file_bytes[16:20], 'big'),
+        int.from_bytes(file_bytes[20:24], 'big'),
+    )
+  if fmt == 'gif' and len(file_bytes) >= 10:
+    return (
+        int.from_bytes(file_bytes[6:8], 'little'),
+        int.from_bytes(file_bytes[8:10], 'little'),
+    )
+  if fmt == 'jpeg':
+    return _parse_jpeg_size(file_bytes)
+  # Other formats, e.g. bmp or tiff, are left to PIL.
+  return None
+
+
+def probe_image_size(fullpath: str, file_bytes: bytes | None = None):
+  """Returns the (width, height) of an image, or None if it's not an image.
+
+  When file_bytes is given, the size is parsed from it and the file is not
+  opened again. Otherwise only the head of the file is read. Formats without a
+  fast parser fall back to PIL, on the same bytes, or on the open file, which
+  PIL only reads up to the header, so large non-image files are never read in
+  full.
+  """
+  try:
+    if file_bytes is None:
+      with open(fullpath, 'rb') as f:
+        image_size = _parse_image_size(f.read(_IMAGE_HEADER_BYTES))
+        if image_size:
+          return image_size
+        f.seek(0)
+        with Image.open(f) as img:
+          return img.size
+    image_size = _parse_image_size(file_bytes)
+    if image_size:
+      return image_size
+    with Image.open(io.BytesIO(file_bytes)) as img:
+      return img.size
+  except Exception:
+    return None
+
+
 @make_dataclass(frozen=True)
 class ImageFileMeta:
   relative_path: str  # Relative path to the src/dst root dir.
@@ -61,22 +418,67 @@ class ImageFileMeta:
   meta: dict[str, Any] = dataclasses.field(default_factory=dict)
 
 
-def generate_html(
-    grouped_images: dict[str, list[ImageFileMeta]],
-    cell_width: int = 100,
-    scale_image_by_width: bool = False,
-    check_first_image_path: bool = True,
-    num_images_in_group_to_show_thres: int = 2,
-):
-  """Generates an HTML table with image links grouped by hash of the image."""
-  html = """
+class FileTable:
+  """The columns of ImageFileMeta for many files, one row per file.
+
+  Millions of ImageFileMeta objects, each with its own path and meta dict, take
+  GBs. Here the directories of the paths are interned, the sizes are in typed
+  arrays, and groups of files are lists of row ids. See get() for the
+  ImageFileMeta of a row.
+  """
+
+  def __init__(self):
+    self._dir_ids = {}  # Maps a directory, with its trailing sep, to its id.
+    self._dirs = []
+    self._row_dir_ids = array.array('I')
+    self._names = []
+    self.size = array.array('q')
+    self.w = array.array('i')
+    self.h = array.array('i')
+
+  def __len__(self):
+    return len(self._names)
+
+  def append(self, relative_path: str, size: int, w: int = 1, h: int = 1):
+    """Adds the file, returns its row id."""
+    row = len(self._names)
+    self._row_dir_ids.append(self._dir_id(relative_path))
+    self._names.append(os.path.basename(relative_path))
+    self.size.append(size)
+    self.w.append(w)
+    self.h.append(h)
+    return row
+
+  def _dir_id(self, path: str) -> int:
+    dir_path = path[:len(path) - len(os.path.basename(path))]
+    dir_id = self._dir_ids.get(dir_path)
+    if dir_id is None:
+      dir_id = self._dir_ids[dir_path] = len(self._dirs)
+      self._dirs.append(dir_path)
+    return dir_id
+
+  def relative_path(self, row: int) -> str:
+    return self._dirs[self._row_dir_ids[row]] + self._names[row]
+
+  def get(self, row: int) -> ImageFileMeta:
+    return ImageFileMeta(
+        relative_path=self.relative_path(row),
+        size=self.size[row],
+        w=self.w[row],
+        h=self.h[row],
+    )
+
+
+_HTML_HEADER = """
   <!DOCTYPE html>
   <html>
   <head>
-  <title>File Group Mappings</title>
+  <meta charset="utf-8">
+  <title>{title}</title>
   </head>
   <body>
-  <h1>File Group Mappings</h1>
+  <h1>{title}</h1>
+  {nav}
   <table>
   <thead>
     <tr>
@@ -87,30 +489,374 @@ def generate_html(
   <tbody>
   """
 
-  for key, file_list in grouped_images.items():
+_HTML_FOOTER = """
+  </tbody>
+  </table>
+  {nav}
+  </body>
+  </html>
+  """
+
+
+def _group_items(
+    grouped_images: Mapping[str, list[ImageFileMeta] | list[int]]
+    | Iterable[tuple[str, list[ImageFileMeta] | list[int]]],
+    num_images_in_group_to_show_thres: int,
+    file_table: FileTable | None = None,
+):
+  """Yields the (group_name, list[ImageFileMeta]) of the groups to show.
+
+  With file_table, the groups are lists of its row ids, and only the rows of the
+  shown groups are read.
+  """
+  if isinstance(grouped_images, Mapping):
+    grouped_images = grouped_images.items()
+  for key, file_list in grouped_images:
     if len(file_list) < num_images_in_group_to_show_thres:
       continue  # Don't show groups that only have one file.
-    html += f'<tr><td>{key}</td><td>'
+    if file_table is not None:
+      file_list = [file_table.get(row) for row in file_list]
+    yield key, file_list
+
 
-    # First file must not be moved, i.e. its path must be relative!
-    first_file = file_list[0]
-    if check_first_image_path:
-      assert not first_file.relative_path.startswith('/')
+def _group_row_html(
+    key: str,
+    file_list: list[ImageFileMeta],
+    cell_width: int,
+    scale_image_by_width: bool,
+    check_first_image_path: bool,
+    html_dir: str = '',
+    thumbnails: dict[str, str] | None = None,
+):
+  # First file must not be moved, i.e. its path must be relative!
+  first_file = file_list[0]
+  if check_first_image_path:
+    assert not first_file.relative_path.startswith('/')
 
-    for file in file_list:
-      width = cell_width
-      if scale_image_by_width:
-        width *= file.w / first_file.w
-      html += f'<img src="{quote(file.relative_path)}" width="{int(width)}px" data-meta="{file.meta}" /> '
-    html += '</td></tr>'
+  parts = [f'<tr><td>{html.escape(str(key))}</td><td>']
+  for file in file_list:
+    width = cell_width
+    if scale_image_by_width:
+      width *= file.w / first_file.w
+    src = quote(file.relative_path)
+    thumbnail = thumbnails and thumbnails.get(
+        os.path.join(html_dir, file.relative_path)
+    )
+    img_html = (
+        f'<img src="{quote(thumbnail) if thumbnail else src}" '
+        f'width="{int(width)}px" loading="lazy" '
+        f'data-meta="{html.escape(str(file.meta))}" />'
+    )
+    if thumbnail:
+      # Link the thumbnail to the original.
+      img_html = f'<a href="{src}">{img_html}</a>'
+    parts.append(f'{img_html} ')
+  parts.append('</td></tr>\n')
+  return ''.join(parts)
 
-  html += """
-  </tbody>
-  </table>
-  </body>
-  </html>
+
+def generate_html(
+    grouped_images: dict[str, list[ImageFileMeta] | list[int]],
+    cell_width: int = 100,
+    scale_image_by_width: bool = False,
+    check_first_image_path: bool = True,
+    num_images_in_group_to_show_thres: int = 2,
+    file_table: FileTable | None = None,
+):
+  """Generates an HTML table with image links grouped by hash of the image.
+
+  Holds the whole document in memory, prefer write_html() for large reports.
+  The groups are lists of row ids of file_table if it's set.
+  """
+  f = io.StringIO()
+  f.write(_HTML_HEADER.format(title='File Group Mappings', nav=''))
+  for key, file_list in _group_items(
+      grouped_images, num_images_in_group_to_show_thres, file_table
+  ):
+    f.write(
+        _group_row_html(
+            key, file_list, cell_width, scale_image_by_width,
+            check_first_image_path
+        )
+    )
+  f.write(_HTML_FOOTER.format(nav=''))
+  return f.getvalue()
+
+
+DEFAULT_THUMBNAIL_DIR = os.path.expanduser('~/.cache/aaroey_image_thumbnails')
+
+
+def _make_thumbnail(fullpath: str, thumbnail_dir: str, width: int):
+  """Returns the path of the thumbnail of the image, creating it if needed.
+
+  Thumbnails are keyed by the MD5 of the content and the width, so they are
+  shared by copies of the same image and survive moves and renames.
+  """
+  try:
+    with open(fullpath, 'rb') as f:
+      file_bytes = f.read()
+    md5 = hashlib.md5(file_bytes).hexdigest()
+    thumbnail_path = os.path.join(thumbnail_dir, md5[:2], f'{md5}_w{width}.jpg')
+    if os.path.exists(thumbnail_path):
+      return thumbnail_path
+
+    with Image.open(io.BytesIO(file_bytes)) as img:
+      # Let the JPEG decoder downscale by DCT scaling when possible.
+      img.draft('RGB', (width, 1))
+      img = img.convert('RGB')
+      img.thumbnail((width, img.height))
+      os.makedirs(os.path.dirname(thumbnail_path), exist_ok=True)
+      # Write to a temp file first so a concurrent run never sees a partial
+      # thumbnail.
+      tmp_path = f'{thumbnail_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+      img.save(tmp_path, 'JPEG', quality=85)
+    os.replace(tmp_path, thumbnail_path)
+    return thumbnail_path
+  except Exception as e:
+    print(f'\033[91m=> Failed to create thumbnail of {fullpath}: {e}\033[0m')
+    return None
+
+
+def make_thumbnails(
+    fullpaths: Iterable[str],
+    width: int,
+    thumbnail_dir: str = DEFAULT_THUMBNAIL_DIR,
+    executor: concurrent.futures.Executor | None = None,
+    thumbnail_cache: dict[str, str | None] | None = None,
+) -> dict[str, str]:
+  """Creates the thumbnails in parallel, returns {fullpath: thumbnail_path}.
+
+  Images whose thumbnail can't be created are not in the result.
+  Finding the cached thumbnail of an image reads the whole image for its MD5.
+  To do that at most once per image when the same images are in several
+  reports, pass the same thumbnail_cache dict, of width-wide thumbnails, to
+  each call. It maps the fullpaths to their thumbnail_path, or None if it
+  can't be created.
+  """
+  fullpaths = list(dict.fromkeys(fullpaths))
+  if thumbnail_cache is None:
+    thumbnail_cache = {}
+  new_fullpaths = [p for p in fullpaths if p not in thumbnail_cache]
+  if new_fullpaths:
+    if executor is None:
+      with concurrent.futures.ThreadPoolExecutor() as executor:
+        return make_thumbnails(
+            fullpaths, width, thumbnail_dir, executor, thumbnail_cache
+        )
+    thumbnail_paths = executor.map(
+        lambda fullpath: _make_thumbnail(fullpath, thumbnail_dir, width),
+        new_fullpaths
+    )
+    thumbnail_cache.update(zip(new_fullpaths, thumbnail_paths))
+  return {
+      fullpath: thumbnail_cache[fullpath]
+      for fullpath in fullpaths
+      if thumbnail_cache[fullpath]
+  }
+
+
+def write_html(
+    html_path: str,
+    grouped_images: Mapping[str, list[ImageFileMeta] | list[int]]
+    | Iterable[tuple[str, list[ImageFileMeta] | list[int]]],
+    cell_width: int = 100,
+    scale_image_by_width: bool = False,
+    check_first_image_path: bool = True,
+    num_images_in_group_to_show_thres: int = 2,
+    groups_per_page: int = 100,
+    thumbnail_dir: str | None = None,
+    file_table: FileTable | None = None,
+    thumbnail_cache: dict[str, str | None] | None = None,
+) -> int:
+  """Writes the image groups to html pages, like generate_html().
+
+  The rows are streamed to pages of at most groups_per_page groups, named
+  <html_path without .html>-000.html, -001.html, etc. Then html_path is written
+  as an index page linking to them. Stale pages of a previous run are removed.
+  The image paths are relative to the directory of html_path.
+
+  Args:
+    grouped_images: {group_name: files} dict, or an iterable of (group_name,
+      files) pairs, e.g. a generator, so the groups don't need to be in memory.
+    thumbnail_dir: When set, the images are shown as thumbnails of twice the
+      cell width cached in this dir, see make_thumbnails(), and link to the
+      originals. The thumbnails of a page are created in parallel before the
+      page is written.
+    file_table: When set, the groups are lists of its row ids.
+    thumbnail_cache: Shared by the reports of the same images, see
+      make_thumbnails().
+
+  Returns:
+    The number of pages.
   """
-  return html
+  html_dir = os.path.dirname(html_path)
+  stem = html_path[:-len('.html')] if html_path.endswith('.html') else html_path
+  page_path = lambda i: f'{stem}-{i:03}.html'
+  page_name = lambda i: os.path.basename(page_path(i))
+  title = os.path.basename(stem)
+
+  def nav(i, has_next):
+    links = [f'<a href="{quote(os.path.basename(html_path))}">index</a>']
+    if i > 0:
+      links.append(f'<a href="{quote(page_name(i - 1))}">prev</a>')
+    if has_next:
+      links.append(f'<a href="{quote(page_name(i + 1))}">next</a>')
+    return ' | '.join(links)
+
+  def iter_pages():
+    page = []
+    for key, file_list in _group_items(
+        grouped_images, num_images_in_group_to_show_thres, file_table
+    ):
+      page.append((key, file_list))
+      if len(page) >= groups_per_page:
+        yield page
+        page = []
+    if page:
+      yield page
+
+  def write_page(i, page, has_next, executor):
+    thumbnails = None
+    if thumbnail_dir:
+      fullpaths = (
+          os.path.join(html_dir, file.relative_path)
+          for _, file_list in page for file in file_list
+      )
+      thumbnails = make_thumbnails(
+          fullpaths, 2 * cell_width, thumbnail_dir, executor, thumbnail_cache
+      )
+    with open(page_path(i), 'w') as f:
+      nav_html = nav(i, has_next)
+      f.write(_HTML_HEADER.format(title=f'{title} - page {i}', nav=nav_html))
+      for key, file_list in page:
+        f.write(
+            _group_row_html(
+                key, file_list, cell_width, scale_image_by_width,
+                check_first_image_path, html_dir, thumbnails
+            )
+        )
+      f.write(_HTML_FOOTER.format(nav=nav_html))
+
+  # (first group, last group, number of groups) of each page.
+  pages = []
+  with concurrent.futures.ThreadPoolExecutor() as executor:
+    # Look one page ahead to know whether to link the next page.
+    page_iter = iter_pages()
+    page = next(page_iter, None)
+    while page is not None:
+      next_page = next(page_iter, None)
+      write_page(len(pages), page, next_page is not None, executor)
+      pages.append((page[0][0], page[-1][0], len(page)))
+      page = next_page
+
+  i = len(pages)
+  while os.path.exists(page_path(i)):
+    os.remove(page_path(i))
+    i += 1
+
+  with open(html_path, 'w') as f:
+    f.write(
+        f'<!DOCTYPE html>\n<html>\n<head>\n<meta charset="utf-8">\n'
+        f'<title>{title}</title>\n</head>\n<body>\n<h1>{title}</h1>\n'
+        f'<p>{sum(p[2] for p in pages)} groups in {len(pages)} pages.</p>\n'
+        '<ol start="0">\n'
+    )
+    for i, (first_key, last_key, num_groups) in enumerate(pages):
+      f.write(
+          f'<li><a href="{quote(page_name(i))}">{num_groups} groups: '
+          f'{html.escape(str(first_key))} ... '
+          f'{html.escape(str(last_key))}</a></li>\n'
+      )
+    f.write('</ol>\n</body>\n</html>\n')
+  return len(pages)
+
+
+def write_manifest(
+    manifest_path: str,
+    grouped_images: Mapping[str, list[ImageFileMeta] | list[int]]
+    | Iterable[tuple[str, list[ImageFileMeta] | list[int]]],
+    cell_width: int = 100,
+    scale_image_by_width: bool = False,
+    num_images_in_group_to_show_thres: int = 2,
+    thumbnail_dir: str | None = None,
+    batch_size: int = 1000,
+    file_table: FileTable | None = None,
+    thumbnail_cache: dict[str, str | None] | None = None,
+) -> int:
+  """Writes the image groups as a json manifest for the browser image viewer.
+
+  The manifest is loaded by browser_image_viewer/main.html, which only renders
+  the visible groups, so a single manifest replaces all the pages written by
+  write_html(). The format is:
+    {
+      "version": 1, "title": str, "root": str, "cell_width": int,
+      "scale_image_by_width": bool,
+      "files": [[path, size, w, h, thumbnail_path or null, meta or null], ...],
+      "groups": [[group_name, index of the first file, number of files], ...]
+    }
+  where the files of a group are consecutive, and relative paths are relative to
+  "root", the directory of the manifest.
+  The files are streamed to the manifest in batches of batch_size, and their
+  thumbnails are created per batch, see make_thumbnails() for thumbnail_cache.
+  The groups are lists of row ids of file_table if it's set.
+
+  Returns:
+    The number of groups.
+  """
+  root = os.path.dirname(os.path.abspath(manifest_path))
+  title = os.path.basename(manifest_path).split('.')[0]
+  # (group_name, first file index, number of files) of each group.
+  groups = []
+  batch = []
+  num_files = 0
+
+  def flush(f, executor):
+    nonlocal num_files
+    thumbnails = {}
+    if thumbnail_dir:
+      thumbnails = make_thumbnails(
+          (os.path.join(root, file.relative_path) for file in batch),
+          2 * cell_width, thumbnail_dir, executor, thumbnail_cache
+      )
+    for file in batch:
+      row = [
+          file.relative_path, file.size, file.w, file.h,
+          thumbnails.get(os.path.join(root, file.relative_path)),
+          file.meta or None
+      ]
+      f.write(',\n' if num_files else '\n')
+      f.write(json.dumps(row, separators=(',', ':'), default=str))
+      num_files += 1
+    batch.clear()
+
+  # Write to a temp file so the viewer never loads a partial manifest.
+  tmp_path = f'{manifest_path}.tmp'
+  with open(tmp_path, 'w') as f, \
+      concurrent.futures.ThreadPoolExecutor() as executor:
+    header = {
+        'version': 1,
+        'title': title,
+        'root': root,
+        'cell_width': cell_width,
+        'scale_image_by_width': scale_image_by_width,
+    }
+    f.write(json.dumps(header)[:-1] + ',\n"files":[')
+    for key, file_list in _group_items(
+        grouped_images, num_images_in_group_to_show_thres, file_table
+    ):
+      groups.append([str(key), num_files + len(batch), len(file_list)])
+      batch.extend(file_list)
+      if len(batch) >= batch_size:
+        flush(f, executor)
+    flush(f, executor)
+
+    f.write('\n],\n"groups":[')
+    for i, group in enumerate(groups):
+      f.write(',\n' if i else '\n')
+      f.write(json.dumps(group, separators=(',', ':')))
+    f.write('\n]}\n')
+  os.replace(tmp_path, manifest_path)
+  return len(groups)
 
 
 def safe_move(src, dst):
@@ -119,6 +865,147 @@ def safe_move(src, dst):
   shutil.move(src, dst)
 
 
+# Journal of the moves made by BulkMover in a destination directory.
+MOVE_JOURNAL_NAME = 'move_journal.jsonl'
+
+
+class BulkMover:
+  """Moves many files at once, faster than calling safe_move() per file.
+
+  Usage:
+    mover = utils.BulkMover()
+    for src, dst in ...:
+      mover.add(src, dst)
+    moved = mover.run()
+
+  Compared to safe_move():
+  - The collisions are found before anything is moved, with one listing per
+    destination directory instead of a stat per file, see find_collisions().
+  - The destination directories are created once and cached.
+  - Files are renamed when on the same device. The others are copied in a
+    thread pool of max_copy_workers.
+
+  When journal_path is set, every move is appended to it as a json line
+  {"run": run_id, "src": src, "dst": dst} right after it's done, so the moves
+  of a run can be undone without walking the destination tree, see
+  move_with_structure.undo_moves(). run_id defaults to the start time and pid.
+  """
+
+  def __init__(
+      self,
+      max_copy_workers: int = 8,
+      journal_path: str | None = None,
+      run_id: str | None = None,
+  ):
+    self.max_copy_workers = max_copy_workers
+    self.journal_path = journal_path
+    self.run_id = run_id or f'{time.strftime("%Y%m%d-%H%M%S")}-{os.getpid()}'
+    self._moves = []  # (src, dst) to move.
+    self._created_dirs = set()
+
+  def __len__(self):
+    return len(self._moves)
+
+  def add(self, src: str, dst: str):
+    self._moves.append((src, dst))
+
+  def find_collisions(self) -> list[tuple[str, str]]:
+    """Returns the (src, dst) whose dst exists or is used by an earlier move."""
+    # macOS file systems are case insensitive by default.
+    normalize = str.casefold if sys.platform == 'darwin' else lambda x: x
+    dir_to_names = {}  # Lazily listed names of the destination directories.
+    seen_dsts = set()
+    collisions = []
+    for src, dst in self._moves:
+      dst_dir, name = os.path.split(dst)
+      if dst_dir not in dir_to_names:
+        try:
+          dir_to_names[dst_dir] = {normalize(n) for n in os.listdir(dst_dir)}
+        except (FileNotFoundError, NotADirectoryError):
+          dir_to_names[dst_dir] = set()
+      key = (dst_dir, normalize(name))
+      if key in seen_dsts or key[1] in dir_to_names[dst_dir]:
+        collisions.append((src, dst))
+      seen_dsts.add(key)
+    return collisions
+
+  def _makedirs(self, dir_path: str):
+    if dir_path and dir_path not in self._created_dirs:
+      os.makedirs(dir_path, exist_ok=True)
+      self._created_dirs.add(dir_path)
+
+  def run(self, on_collision: str = 'raise') -> list[tuple[str, str]]:
+    """Moves the added files, returns the (src, dst) that were moved.
+
+    Args:
+      on_collision: 'raise' to raise a ValueError before moving anything if any
+        destination collides, or 'skip' to move the others.
+    """
+    assert on_collision in ('raise', 'skip'), f'{on_collision=}'
+    collisions = set(self.find_collisions())
+    moves, self._moves = self._moves, []
+    if collisions and on_collision == 'raise':
+      raise ValueError(
+          f'{len(collisions)} destinations already exist, e.g. '
+          f'{next(iter(collisions))[1]}'
+      )
+    for _, dst in collisions:
+      print(f'\033[91m=> Not moving to {dst}, it already exists.\033[0m')
+    if len(collisions) == len(moves):
+      return []
+
+    profiler = current_profiler()
+    moved = []
+    to_copy = []  # Moves across devices.
+    with profiler.stage('move'), self._open_journal() as journal:
+
+      def on_moved(src, dst):
+        moved.append((src, dst))
+        if journal:
+          journal.write(
+              json.dumps({'run': self.run_id, 'src': src, 'dst': dst}) + '\n'
+          )
+
+      for src, dst in moves:
+        if (src, dst) in collisions:
+          continue
+        try:
+          self._makedirs(os.path.dirname(dst))
+          os.rename(src, dst)
+          on_moved(src, dst)
+        except OSError as e:
+          if e.errno == errno.EXDEV:
+            to_copy.append((src, dst))
+          else:
+            print(f'\033[91m=> Failed to move {src} to {dst}: {e}\033[0m')
+      profiler.count('renamed_files', len(moved))
+
+      def copy(src_dst):
+        try:
+          shutil.move(*src_dst)
+          return True
+        except OSError as e:
+          print(f'\033[91m=> Failed to move {src_dst[0]}: {e}\033[0m')
+          return False
+
+      if to_copy:
+        with concurrent.futures.ThreadPoolExecutor(
+            self.max_copy_workers
+        ) as executor:
+          for src_dst, ok in zip(to_copy, executor.map(copy, to_copy)):
+            if ok:
+              on_moved(*src_dst)
+              profiler.count('copied_files')
+    return moved
+
+  def _open_journal(self):
+    if not self.journal_path:
+      return contextlib.nullcontext()
+    self._makedirs(os.path.dirname(self.journal_path))
+    # Line buffered, so the moves done before a crash are all journaled.
+    return open(self.journal_path, 'a', buffering=1)
+
+
 def move_with_roots(src_root_dir, dst_root_dir, relpath, move_fn=safe_move):
   src_path = os.path.join(src_root_dir, relpath)
   dst_path = os.path.join(dst_root_dir, relpath)